@@ -40,7 +40,8 @@ setup(name='stormberry',
     entry_points={
         'console_scripts': [
             'stormberry = stormberry.station.__main__:main',
-            'stormberry-demo-server = stormberry.server.server:demo'
+            'stormberry-demo-server = stormberry.server.server:demo',
+            'stormberry-sqlite-rollups = stormberry.pluggable.sqlitestore:rebuild_rollups'
         ]
     },
     test_suite='nose.collector',
@@ -0,0 +1,272 @@
+import functools
+import logging
+import math
+import os
+import struct
+import threading
+from bisect import bisect_left
+from datetime import datetime
+import stormberry.plugin
+from stormberry.util import aggregate_readings, extremes_of_readings, mean_of_readings, to_epoch
+from stormberry.util.compression import BitReader, BitWriter, decode_floats, decode_timestamps, encode_floats, encode_timestamps
+from stormberry.weather_reading import WeatherReading
+
+
+class CompressedArchive(stormberry.plugin.IRepositoryPlugin):
+    '''
+    Stores readings compressed, in blocks of BLOCK_HOURS aligned to
+    the epoch. Timestamps are kept to the second as delta-of-deltas and
+    each value as the XOR with the one before it (see
+    stormberry.util.compression), which takes a steady stream of
+    readings down to a few bytes each.
+
+    Readings for the block still being filled are appended
+    uncompressed to a journal, which is sealed into a compressed block
+    once a reading for a later block arrives. Range reads only decode
+    the blocks they overlap.
+
+    Alongside a repository with a retention policy, such as the
+    SQLite3 Datastore, this keeps the long term history.
+    '''
+
+    thread_safe = True
+
+    # first epoch, last epoch, reading count, payload length
+    block_header = struct.Struct('<qqII')
+    journal_row = struct.Struct('<q%dd' % len(WeatherReading.RAW_FIELDS))
+
+    def prepare(self, config, data_manager):
+        self.config = config
+        self.data_manager = data_manager
+        self.directory = config.get('ARCHIVE', 'DIRECTORY')
+        self.block_seconds = int(config.getfloat('ARCHIVE', 'BLOCK_HOURS', fallback=2) * 3600)
+        self._lock = threading.RLock()
+        self._blocks_file = None
+        self._journal = None
+        self._reader = None
+        self._open_rows = None
+        # (first epoch, last epoch, count, payload offset, payload length)
+        self._index = []
+        self._index_ends = []
+        self._indexed_size = 0
+        self._decode = functools.lru_cache(
+                maxsize=config.getint('ARCHIVE', 'DECODED_BLOCKS', fallback=16)
+                )(self._decode_block)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            open(self._path('blocks'), 'ab').close()
+            open(self._path('journal'), 'ab').close()
+        except OSError as e:
+            logging.error("Unable to use archive directory %s: %s" % (self.directory, str(e)))
+            return False
+
+        return True
+
+    def shutdown(self):
+        # The open block stays in the journal and is picked up again
+        # on the next start
+        with self._lock:
+            for f in (self._blocks_file, self._journal, self._reader):
+                if f is not None:
+                    f.close()
+
+            self._blocks_file = None
+            self._journal = None
+            self._reader = None
+            self._open_rows = None
+
+    def health_check(self):
+        return os.access(self._path('blocks'), os.W_OK)
+
+    def store_reading(self, data):
+        return self.store_readings([data])
+
+    def store_readings(self, readings):
+        with self._lock:
+            if self._journal is None:
+                self._open_writers()
+
+            for reading in readings:
+                epoch = int(reading.timestamp.timestamp())
+                if len(self._open_rows) > 0:
+                    last = self._open_rows[-1][0]
+                elif len(self._index) > 0:
+                    last = self._index[-1][1]
+                else:
+                    last = None
+
+                if last is not None and epoch < last:
+                    logging.warning("Not archiving out of order reading from %s" % reading.timestr)
+                    continue
+
+                if len(self._open_rows) > 0 and epoch // self.block_seconds != last // self.block_seconds:
+                    self._seal()
+
+                row = (epoch,) + tuple(math.nan if value is None else value for value in reading.raw)
+                self._open_rows.append(row)
+                self._journal.write(self.journal_row.pack(*row))
+
+            self._journal.flush()
+
+        return True
+
+    def get_latest(self):
+        with self._lock:
+            open_rows = self._current_open_rows()
+            if len(open_rows) > 0:
+                return self._reading(open_rows[-1])
+
+            if len(self._index) == 0:
+                return None
+
+            epochs, columns = self._decode(*self._index[-1][2:])
+            return self._reading((epochs[-1],) + tuple(column[-1] for column in columns))
+
+    def get_between(self, start_time, end_time = None):
+        return list(self.iter_between(start_time, end_time))
+
+    def get_mean_between(self, start_time, end_time = None):
+        return mean_of_readings(self.get_between(start_time, end_time))
+
+    def get_extremes_between(self, start_time, end_time = None):
+        return extremes_of_readings(self.get_between(start_time, end_time))
+
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        return aggregate_readings(
+                self.iter_between(start_time, end_time),
+                bucket_seconds,
+                self.aggregate_fields
+                )
+
+    def iter_between(self, start_time, end_time = None):
+        start = math.floor(to_epoch(start_time))
+        end = math.floor(to_epoch(end_time)) if end_time is not None else math.inf
+
+        with self._lock:
+            open_rows = self._current_open_rows()
+            blocks = self._index[bisect_left(self._index_ends, start):]
+
+        for first, last, count, offset, length in blocks:
+            if first > end:
+                return
+
+            epochs, columns = self._decode(count, offset, length)
+            for i in range(bisect_left(epochs, start), count):
+                if epochs[i] > end:
+                    return
+                yield self._reading((epochs[i],) + tuple(column[i] for column in columns))
+
+        for row in open_rows:
+            if row[0] > end:
+                return
+            if row[0] >= start:
+                yield self._reading(row)
+
+    def _reading(self, row):
+        return WeatherReading.from_raw(
+                datetime.fromtimestamp(row[0]),
+                [None if math.isnan(value) else value for value in row[1:]]
+                )
+
+    def _seal(self):
+        '''
+        Compresses the open block onto the end of the block file and
+        empties the journal.
+        '''
+        rows = self._open_rows
+        writer = BitWriter()
+        encode_timestamps(writer, [row[0] for row in rows])
+        for i in range(1, len(WeatherReading.RAW_FIELDS) + 1):
+            encode_floats(writer, [row[i] for row in rows])
+
+        payload = writer.getvalue()
+        offset = self._blocks_file.seek(0, os.SEEK_END) + self.block_header.size
+        self._blocks_file.write(self.block_header.pack(rows[0][0], rows[-1][0], len(rows), len(payload)))
+        self._blocks_file.write(payload)
+        self._blocks_file.flush()
+        os.fsync(self._blocks_file.fileno())
+
+        self._add_to_index(rows[0][0], rows[-1][0], len(rows), offset, len(payload))
+        self._indexed_size = offset + len(payload)
+
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        self._open_rows = []
+
+    def _decode_block(self, count, offset, length):
+        with self._lock:
+            self._reader.seek(offset)
+            payload = self._reader.read(length)
+
+        reader = BitReader(payload)
+        epochs = decode_timestamps(reader, count)
+        columns = [decode_floats(reader, count) for field in WeatherReading.RAW_FIELDS]
+        return epochs, columns
+
+    def _current_open_rows(self):
+        '''
+        Brings the block index up to date and returns the readings
+        not yet sealed into a block. Only the station holds these in
+        memory; other processes read them from the journal.
+        '''
+        self._load_index()
+        if self._open_rows is not None:
+            return list(self._open_rows)
+
+        with open(self._path('journal'), 'rb') as f:
+            journal = f.read()
+
+        sealed_until = self._index[-1][1] if len(self._index) > 0 else None
+        rows = []
+        for position in range(0, len(journal) - self.journal_row.size + 1, self.journal_row.size):
+            row = self.journal_row.unpack_from(journal, position)
+            # Rows from a block sealed since the journal was emptied
+            if sealed_until is None or row[0] > sealed_until:
+                rows.append(row)
+
+        return rows
+
+    def _load_index(self):
+        '''
+        Reads the headers of blocks added to the block file since it
+        was last indexed.
+        '''
+        if self._reader is None:
+            self._reader = open(self._path('blocks'), 'rb')
+
+        size = os.fstat(self._reader.fileno()).st_size
+        while self._indexed_size + self.block_header.size <= size:
+            self._reader.seek(self._indexed_size)
+            first, last, count, length = self.block_header.unpack(self._reader.read(self.block_header.size))
+            offset = self._indexed_size + self.block_header.size
+            if offset + length > size:
+                # Still being written
+                break
+
+            self._add_to_index(first, last, count, offset, length)
+            self._indexed_size = offset + length
+
+    def _add_to_index(self, first, last, count, offset, length):
+        self._index.append((first, last, count, offset, length))
+        self._index_ends.append(last)
+
+    def _open_writers(self):
+        self._load_index()
+
+        # Drop a block left half written by an interrupted seal
+        self._blocks_file = open(self._path('blocks'), 'r+b')
+        self._blocks_file.truncate(self._indexed_size)
+
+        # Rewrite the journal without a partial last row or any rows
+        # already sealed
+        rows = self._current_open_rows()
+        self._journal = open(self._path('journal'), 'r+b')
+        self._journal.truncate(0)
+        for row in rows:
+            self._journal.write(self.journal_row.pack(*row))
+        self._journal.flush()
+        self._open_rows = rows
+
+    def _path(self, name):
+        return os.path.join(self.directory, 'stormberry.' + name)
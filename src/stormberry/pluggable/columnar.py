@@ -0,0 +1,212 @@
+import logging
+import math
+import mmap
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import stormberry.plugin
+from stormberry.util import aggregate_readings, extremes_of_readings, mean_of_readings, to_epoch
+from stormberry.weather_reading import WeatherReading
+
+
+class ColumnarStore(stormberry.plugin.IRepositoryPlugin):
+    '''
+    Stores readings as fixed width columns, one file of native doubles
+    per column: the reading time in epoch seconds, kept in time order,
+    and each measured value (NaN when missing). Reads map the files
+    into memory and binary search the epoch column, so nothing is
+    parsed and only the rows in range are touched.
+    '''
+
+    thread_safe = True
+
+    columns = ('epoch',) + WeatherReading.RAW_FIELDS
+    column_width = array('d').itemsize
+    # What get_mean_between and get_extremes_between are worked out
+    # from, dewpointc included
+    summary_columns = ('tempc', 'humidity', 'pm_2_5', 'pm_10')
+
+    def prepare(self, config, data_manager):
+        self.config = config
+        self.data_manager = data_manager
+        self.directory = config.get('COLUMNAR', 'DIRECTORY')
+        self._lock = threading.RLock()
+        self._writers = None
+        self._readers = None
+        self._maps = []
+        self._views = {}
+        self._mapped_rows = 0
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for column in self.columns:
+                open(self._path(column), 'ab').close()
+        except OSError as e:
+            logging.error("Unable to use column directory %s: %s" % (self.directory, str(e)))
+            return False
+
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            self._unmap()
+
+            for files in (self._writers, self._readers):
+                if files is not None:
+                    for f in files.values():
+                        f.close()
+
+            self._writers = None
+            self._readers = None
+
+    def health_check(self):
+        return os.access(self._path('epoch'), os.W_OK)
+
+    def store_reading(self, data):
+        return self.store_readings([data])
+
+    def store_readings(self, readings):
+        with self._lock:
+            if self._writers is None:
+                self._open_writers()
+
+            rows = dict((column, array('d')) for column in self.columns)
+            for reading in readings:
+                epoch = reading.timestamp.timestamp()
+                if epoch < self._last_epoch:
+                    logging.warning("Not storing out of order reading from %s" % reading.timestr)
+                    continue
+
+                self._last_epoch = epoch
+                rows['epoch'].append(epoch)
+                for column, value in zip(WeatherReading.RAW_FIELDS, reading.raw):
+                    rows[column].append(math.nan if value is None else value)
+
+            # The epoch column goes last; readers only see rows that
+            # every column has.
+            for column in WeatherReading.RAW_FIELDS + ('epoch',):
+                rows[column].tofile(self._writers[column])
+                self._writers[column].flush()
+
+        return True
+
+    def get_latest(self):
+        with self._lock:
+            rows = self._map()
+            if rows == 0:
+                return None
+
+            return self._reading_at(rows - 1)
+
+    def get_between(self, start_time, end_time = None):
+        with self._lock:
+            first, last = self._row_range(start_time, end_time)
+            return [self._reading_at(i) for i in range(first, last)]
+
+    def get_mean_between(self, start_time, end_time = None):
+        return mean_of_readings(self._iter_columns(start_time, end_time, self.summary_columns))
+
+    def get_extremes_between(self, start_time, end_time = None):
+        return extremes_of_readings(self._iter_columns(start_time, end_time, self.summary_columns))
+
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        with self._lock:
+            first, last = self._row_range(start_time, end_time)
+            readings = (self._reading_at(i) for i in range(first, last))
+            return aggregate_readings(readings, bucket_seconds, self.aggregate_fields)
+
+    def _iter_columns(self, start_time, end_time, columns):
+        '''
+        Yields a reading for each row in the range with only the
+        values in columns filled in, so the other column files
+        aren't read.
+        '''
+        with self._lock:
+            first, last = self._row_range(start_time, end_time)
+            slices = [self._views[column][first:last] for column in columns]
+
+            for values in zip(*slices):
+                yield WeatherReading(**dict(
+                        (column, self._value(value)) for column, value in zip(columns, values)
+                        ))
+
+    def _row_range(self, start_time, end_time):
+        rows = self._map()
+        if rows == 0:
+            return 0, 0
+
+        epochs = self._views['epoch']
+        first = bisect_left(epochs, to_epoch(start_time))
+        last = rows if end_time is None else bisect_right(epochs, to_epoch(end_time))
+        return first, last
+
+    def _reading_at(self, index):
+        return WeatherReading.from_raw(
+                datetime.fromtimestamp(self._views['epoch'][index]),
+                [self._value(self._views[column][index]) for column in WeatherReading.RAW_FIELDS]
+                )
+
+    def _value(self, value):
+        return None if math.isnan(value) else value
+
+    def _map(self):
+        '''
+        Maps the column files, again if they've grown since they were
+        last mapped, and returns the number of complete rows.
+        '''
+        if self._readers is None:
+            self._readers = dict((column, open(self._path(column), 'rb')) for column in self.columns)
+
+        rows = min(
+                os.fstat(f.fileno()).st_size // self.column_width
+                for f in self._readers.values()
+                )
+
+        if rows != self._mapped_rows:
+            self._unmap()
+            if rows > 0:
+                for column, f in self._readers.items():
+                    mapped = mmap.mmap(f.fileno(), rows * self.column_width, access=mmap.ACCESS_READ)
+                    self._maps.append(mapped)
+                    self._views[column] = memoryview(mapped).cast('d')
+
+            self._mapped_rows = rows
+
+        return rows
+
+    def _unmap(self):
+        for view in self._views.values():
+            view.release()
+
+        for mapped in self._maps:
+            mapped.close()
+
+        self._views = {}
+        self._maps = []
+        self._mapped_rows = 0
+
+    def _open_writers(self):
+        # Drop any partial row left by an interrupted write so all
+        # columns line up again
+        rows = min(
+                os.path.getsize(self._path(column)) // self.column_width
+                for column in self.columns
+                )
+
+        self._writers = {}
+        for column in self.columns:
+            f = open(self._path(column), 'r+b')
+            f.truncate(rows * self.column_width)
+            f.seek(0, os.SEEK_END)
+            self._writers[column] = f
+
+        self._last_epoch = -math.inf
+        if rows > 0:
+            self._writers['epoch'].seek((rows - 1) * self.column_width)
+            self._last_epoch = array('d', self._writers['epoch'].read(self.column_width))[0]
+            self._writers['epoch'].seek(0, os.SEEK_END)
+
+    def _path(self, column):
+        return os.path.join(self.directory, column + '.col')
@@ -1,40 +1,403 @@
 import csv
+import io
+import logging
 import os
+import shutil
+import struct
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
 import stormberry.plugin
+from stormberry.util import extremes_of_readings, mean_of_readings, parse_time
+from stormberry.weather_reading import WeatherReading
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# The index starts with the inode of the file it's for, followed by
+# the epoch and byte offset of every INDEX_INTERVAL'th row
+INDEX_HEADER = struct.Struct('<Q')
+INDEX_ENTRY = struct.Struct('<dQ')
 
 class CSVWriter(stormberry.plugin.IRepositoryPlugin):
+    '''
+    Appends readings to a CSV file, kept open between readings. Each
+    batch is handed to the OS as it's written, and the file is synced
+    to disk at most every SYNC_INTERVAL seconds and on shutdown. If
+    the file is moved away (by logrotate, for example) a new one is
+    started.
+
+    Every INDEX_INTERVAL rows, the time and position of the row are
+    added to an index next to the file, so reading a range of times
+    only reads the rows from just before it, and the latest reading
+    comes from the end of the file. The index is rebuilt whenever it
+    doesn't match the file.
+    '''
+
+    thread_safe = True
+
+    fieldnames = ["timestr", "tempc", "tempf", "humidity", "inchesHg", "dewpointc"]
 
     def prepare(self, config, data_manager):
         self.config = config
+        self.filename = config['CSV']['FILENAME']
+        self.sync_interval = config.getfloat('CSV', 'SYNC_INTERVAL', fallback=60)
+        self.index_interval = config.getint('CSV', 'INDEX_INTERVAL', fallback=360)
+        self.index_filename = self.filename + '.idx'
+        self._lock = threading.Lock()
+        self._file = None
+        self._index = None
+        self._unindexed = 0
+        self._inode = None
+        self._last_sync = None
+        # Overwriting only happens the first time this process writes
+        self._overwrite = config['CSV']['BEHAVIOUR'] == "overwrite"
+
+        # What's been read of the index, for get_between
+        self._read_lock = threading.Lock()
+        self._read_inode = None
+        self._read_position = None
+        self._read_epochs = []
+        self._read_offsets = []
+
+    def shutdown(self):
+        with self._lock:
+            self._close()
 
     def store_reading(self, data):
+        return self.store_readings([data])
+
+    def store_readings(self, readings):
 
-        behaviour = self.config['CSV']['BEHAVIOUR']
-        filename = self.config['CSV']['FILENAME']
+        rows = [self._format_row((
+            data.timestr,
+            data.tempc,
+            data.tempf,
+            data.humidity,
+            data.pressure_inHg,
+            data.dewpointc
+            )) for data in readings]
 
-        csv_file_exists = os.path.exists(filename)
+        with self._lock:
+            self._open()
 
-        if csv_file_exists and behaviour == "overwrite":
-            os.unlink(filename)
-            csv_file_exists = False
+            offset = self._file.tell()
+            entries = []
+            for data, row in zip(readings, rows):
+                if self._unindexed >= self.index_interval and data.timestamp is not None:
+                    entries.append(INDEX_ENTRY.pack(data.timestamp.timestamp(), offset))
+                    self._unindexed = 0
 
-        with open(filename, 'a') as csv_file:
-            fieldnames = ["timestr", "tempc", "tempf", "humidity", "inchesHg", "dewpointc"]
-            writer = csv.DictWriter(csv_file, fieldnames)
+                self._unindexed += 1
+                offset += len(row)
 
-            if not csv_file_exists:
-                writer.writeheader()
+            self._file.write(b"".join(rows))
+            self._file.flush()
 
-            writer.writerow({
-                'tempc': data.tempc,
-                'tempf': data.tempf,
-                'timestr': data.timestr,
-                'humidity': data.humidity,
-                'inchesHg': data.pressure_inHg,
-                'dewpointc': data.dewpointc
-                })
+            # After the rows, so the index never points past them
+            if len(entries) > 0:
+                self._index.write(b"".join(entries))
+                self._index.flush()
+
+            if time.monotonic() - self._last_sync >= self.sync_interval:
+                os.fsync(self._file.fileno())
+                self._last_sync = time.monotonic()
 
         return True
 
+    def _open(self):
+        '''
+        Opens the file to append to, again if it has been moved or
+        deleted since it was last opened.
+        '''
+        if self._file is not None:
+            try:
+                if os.stat(self.filename).st_ino == self._inode:
+                    return
+            except FileNotFoundError:
+                pass
+
+            logging.info("%s was moved or removed. Starting a new file." % self.filename)
+            self._close()
+
+        if self._overwrite and os.path.exists(self.filename):
+            os.unlink(self.filename)
+        self._overwrite = False
+
+        self._file = open(self.filename, 'ab')
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._last_sync = time.monotonic()
+
+        if self._file.seek(0, os.SEEK_END) == 0:
+            self._file.write(self._format_row(self.fieldnames))
+            self._file.flush()
+
+        self._open_index()
+
+    def _open_index(self):
+        '''
+        Opens the index to append to, rebuilding it first if it isn't
+        for the file being written.
+        '''
+        with open(self.filename, 'rb') as csv_file:
+            size = os.fstat(csv_file.fileno()).st_size
+            index = self._load_index(csv_file, self._inode, size)
+
+            if index is None or index[2] != os.path.getsize(self.index_filename):
+                logging.info("Rebuilding the index for %s" % self.filename)
+                epochs, offsets = self._scan(csv_file, self._first_row(csv_file))
+                with open(self.index_filename + '.tmp', 'wb') as index_file:
+                    index_file.write(INDEX_HEADER.pack(self._inode))
+                    index_file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in zip(epochs, offsets)))
+
+                os.replace(self.index_filename + '.tmp', self.index_filename)
+
+        self._index = open(self.index_filename, 'ab')
+        # Start with an entry for the next row
+        self._unindexed = self.index_interval
+
+    def _close(self):
+        if self._file is None:
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+        self._index.close()
+        self._index = None
+
+    def compact(self):
+        '''
+        Drops readings older than RETENTION_DAYS by rewriting the
+        file without them. Rows are in time order, so everything from
+        the first row worth keeping onwards is copied as-is.
+        '''
+        days = self.config.get('CSV', 'RETENTION_DAYS', fallback='').strip()
+        filename = self.filename
+
+        if days == '' or not os.path.exists(filename):
+            return
+
+        # timestr sorts the same way as the time it represents
+        cutoff = (datetime.now() - timedelta(days=float(days))).strftime("%Y-%m-%d %H:%M:%S")
+        compacted_filename = filename + '.compact'
+
+        with self._lock:
+            with open(filename, 'r', newline='') as csv_file:
+                header = csv_file.readline()
+                position = csv_file.tell()
+                line = csv_file.readline()
+                dropped = 0
+
+                while line and line < cutoff:
+                    dropped += 1
+                    position = csv_file.tell()
+                    line = csv_file.readline()
+
+                if dropped == 0:
+                    return
+
+                csv_file.seek(position)
+                with open(compacted_filename, 'w', newline='') as compacted_file:
+                    compacted_file.write(header)
+                    shutil.copyfileobj(csv_file, compacted_file)
+
+            os.replace(compacted_filename, filename)
+            # Carry on writing to the compacted file
+            self._close()
+
+        logging.info("Compacted %d rows from %s" % (dropped, filename))
+
     def health_check(self):
-        return os.access(self.config['CSV']['FILENAME'], os.W_OK)
+        return os.access(self.filename, os.W_OK)
+
+    def get_latest(self):
+        try:
+            csv_file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return None
+
+        with csv_file:
+            first_row = self._first_row(csv_file)
+            end = csv_file.seek(0, os.SEEK_END)
+            chunk_size = 4096
+
+            # Read back from the end until there's a whole row
+            while True:
+                start = max(first_row, end - chunk_size)
+                csv_file.seek(start)
+                lines = csv_file.read(end - start).split(b"\n")[:-1]
+                if start > first_row:
+                    # The first may be part of a row
+                    lines = lines[1:]
+
+                for line in reversed(lines):
+                    reading = self._parse_row(line)
+                    if reading is not None:
+                        return reading
+
+                if start == first_row:
+                    return None
+
+                chunk_size *= 2
+
+    def get_between(self, start_time, end_time = None):
+        return list(self.iter_between(start_time, end_time))
+
+    def get_mean_between(self, start_time, end_time = None):
+        return mean_of_readings(self.iter_between(start_time, end_time))
+
+    def get_extremes_between(self, start_time, end_time = None):
+        return extremes_of_readings(self.iter_between(start_time, end_time))
+
+    def iter_between(self, start_time, end_time = None):
+        start = parse_time(start_time)
+        end = parse_time(end_time) if end_time is not None else None
+
+        try:
+            csv_file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+
+        with csv_file:
+            with self._read_lock:
+                self._refresh_index(csv_file)
+                # The last indexed row before the start, as there may
+                # be more rows at the same time before an indexed one
+                i = bisect_left(self._read_epochs, start.timestamp()) - 1
+                offset = self._read_offsets[i] if i >= 0 else self._first_row(csv_file)
+
+            csv_file.seek(offset)
+            for line in csv_file:
+                if not line.endswith(b"\n"):
+                    return
+
+                reading = self._parse_row(line)
+                if reading is None or reading.timestamp < start:
+                    continue
+                if end is not None and reading.timestamp > end:
+                    return
+
+                yield reading
+
+    def _refresh_index(self, csv_file):
+        '''
+        Brings what's been read of the index up to date with the
+        file, reading only what's been added to it since last time.
+        Files without a usable index are indexed in memory.
+        '''
+        stat = os.fstat(csv_file.fileno())
+
+        if stat.st_ino == self._read_inode and len(self._read_offsets) > 0 and self._read_offsets[-1] >= stat.st_size:
+            # Truncated in place
+            self._read_inode = None
+
+        if stat.st_ino == self._read_inode and self._read_position is not None:
+            try:
+                with open(self.index_filename, 'rb') as index_file:
+                    data = index_file.read()
+            except FileNotFoundError:
+                data = b""
+
+            if len(data) >= self._read_position:
+                epochs, offsets = self._unpack_entries(data, self._read_position)
+                if len(offsets) == 0 or offsets[-1] < stat.st_size:
+                    self._read_epochs.extend(epochs)
+                    self._read_offsets.extend(offsets)
+                    self._read_position += len(offsets) * INDEX_ENTRY.size
+                    return
+
+        index = self._load_index(csv_file, stat.st_ino, stat.st_size)
+        if index is not None:
+            self._read_epochs, self._read_offsets, self._read_position = index
+        elif stat.st_ino != self._read_inode or self._read_position is not None:
+            # Until the writer catches up
+            self._read_epochs, self._read_offsets = self._scan(csv_file, self._first_row(csv_file))
+            self._read_position = None
+
+        self._read_inode = stat.st_ino
+
+    def _load_index(self, csv_file, inode, size):
+        '''
+        Reads the index if it's for the file, returning its epochs,
+        offsets and how many bytes of it were read, or None.
+        '''
+        try:
+            with open(self.index_filename, 'rb') as index_file:
+                data = index_file.read()
+        except FileNotFoundError:
+            return None
+
+        if len(data) < INDEX_HEADER.size or INDEX_HEADER.unpack_from(data)[0] != inode:
+            return None
+
+        epochs, offsets = self._unpack_entries(data, INDEX_HEADER.size)
+
+        # A file can be replaced by one with the same inode, so check
+        # the last entry is still right
+        if len(offsets) > 0:
+            if offsets[-1] >= size:
+                return None
+
+            csv_file.seek(offsets[-1])
+            reading = self._parse_row(csv_file.readline())
+            if reading is None or reading.timestamp.timestamp() != epochs[-1]:
+                return None
+
+        return epochs, offsets, INDEX_HEADER.size + len(offsets) * INDEX_ENTRY.size
+
+    def _unpack_entries(self, data, position):
+        # Leaving off an entry still being written
+        count = (len(data) - position) // INDEX_ENTRY.size
+        entries = [INDEX_ENTRY.unpack_from(data, position + i * INDEX_ENTRY.size) for i in range(count)]
+        return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+    def _scan(self, csv_file, offset):
+        '''
+        Indexes the file from offset by reading through it.
+        '''
+        epochs = []
+        offsets = []
+        unindexed = self.index_interval
+
+        csv_file.seek(offset)
+        for line in csv_file:
+            if not line.endswith(b"\n"):
+                break
+
+            if unindexed >= self.index_interval:
+                reading = self._parse_row(line)
+                if reading is not None:
+                    epochs.append(reading.timestamp.timestamp())
+                    offsets.append(offset)
+                    unindexed = 0
+
+            unindexed += 1
+            offset += len(line)
+
+        return epochs, offsets
+
+    def _first_row(self, csv_file):
+        csv_file.seek(0)
+        return len(csv_file.readline())
+
+    def _format_row(self, values):
+        row = io.StringIO()
+        csv.writer(row).writerow(values)
+        return row.getvalue().encode('utf-8')
+
+    def _parse_row(self, line):
+        '''
+        Turns a row of the file back into a WeatherReading, or None
+        if it isn't one.
+        '''
+        try:
+            row = next(csv.reader([line.decode('utf-8')]))
+            values = [float(value) if value != '' else None for value in row[1:5]]
+            date = datetime.strptime(row[0], TIME_FORMAT)
+        except (ValueError, IndexError, StopIteration, UnicodeDecodeError):
+            return None
+
+        tempc, tempf, humidity, inchesHg = values
+        return WeatherReading(tempc=tempc, humidity=humidity, pressureInchesHg=inchesHg, date=date)
@@ -1,6 +1,8 @@
 import logging
 import gspread
 import json
+import threading
+import time
 from oauth2client.service_account import ServiceAccountCredentials
 import stormberry.plugin
 
@@ -8,10 +10,30 @@ import stormberry.plugin
 class GSheetUploader(stormberry.plugin.IRepositoryPlugin):
     '''
     Based on code from https://www.hackster.io/idreams/make-a-mini-weather-station-with-a-raspberry-pi-447866
+
+    Readings are collected and appended to the sheet in one request
+    once FLUSH_INTERVAL seconds have passed since the last upload or
+    BATCH_SIZE readings are waiting. Rows that fail to upload are kept
+    for the next try, up to MAX_PENDING of the newest.
     '''
 
     worksheet = None
 
+    def prepare(self, config, data_manager):
+        self.config = config
+        self.data_manager = data_manager
+        self.flush_interval = config.getfloat("GSHEETS", "FLUSH_INTERVAL", fallback=60)
+        self.batch_size = config.getint("GSHEETS", "BATCH_SIZE", fallback=100)
+        self.max_pending = config.getint("GSHEETS", "MAX_PENDING", fallback=10000)
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._retrying = False
+        self._lock = threading.Lock()
+        return True
+
+    def shutdown(self):
+        self.flush()
+
     def _open_worksheet(self, keyfile, sheet):
         try:
             with open(keyfile) as k:
@@ -27,6 +49,48 @@ class GSheetUploader(stormberry.plugin.IRepositoryPlugin):
             logging.error("Unable to access google sheet:" + str(e))
 
     def store_reading(self, data):
+        with self._lock:
+            self._pending.append(self._row(data))
+            self._trim_pending()
+
+            # After a failure, wait out the interval rather than
+            # trying again with every reading
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+            if not due and (self._retrying or len(self._pending) < self.batch_size):
+                return True
+
+            return self._flush()
+
+    def store_readings(self, readings):
+        '''
+        Uploads the readings right away, with anything already
+        waiting, so the result says whether they made it. If they
+        didn't, they're left for the caller to try again rather than
+        kept, so a retried batch isn't uploaded twice.
+        '''
+        rows = [self._row(data) for data in readings]
+        with self._lock:
+            self._pending.extend(rows)
+            self._trim_pending()
+            if self._flush():
+                return True
+
+            unsent = set(id(row) for row in rows)
+            self._pending = [row for row in self._pending if id(row) not in unsent]
+            return False
+
+    def flush(self):
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        self._retrying = not self._upload()
+        return not self._retrying
+
+    def _upload(self):
+        if len(self._pending) == 0:
+            return True
 
         if self.worksheet is None:
             self.worksheet = self._open_worksheet(
@@ -34,17 +98,36 @@ class GSheetUploader(stormberry.plugin.IRepositoryPlugin):
                     self.config.get("GSHEETS", "GDOCS_SPREADSHEET_NAME")
                     )
 
+        rows = self._pending
         try:
-            self.worksheet.append_row((
-                    data.timestr,
-                    data.tempc,
-                    data.humidity,
-                    data.pressure_inHg,
-                    data.dewpointc
-                    ))
-            return True
+            response = self.worksheet.append_rows(rows)
         except Exception as e:
-            logging.warning("Error appending to google sheet: " + str(e))
+            logging.warning("Error appending %d rows to google sheet: %s" % (len(rows), str(e)))
             self.worksheet = None
             return False
 
+        # The sheet says how many rows it took; keep any it didn't
+        appended = len(rows)
+        if isinstance(response, dict):
+            appended = response.get('updates', {}).get('updatedRows', appended)
+
+        self._pending = rows[appended:]
+        if len(self._pending) > 0:
+            logging.warning("Google sheet only took %d of %d rows" % (appended, len(rows)))
+            return False
+
+        return True
+
+    def _trim_pending(self):
+        if len(self._pending) > self.max_pending:
+            logging.warning("Dropping the oldest %d rows waiting for the google sheet" % (len(self._pending) - self.max_pending))
+            del self._pending[:len(self._pending) - self.max_pending]
+
+    def _row(self, data):
+        return [
+                data.timestr,
+                data.tempc,
+                data.humidity,
+                data.pressure_inHg,
+                data.dewpointc
+                ]
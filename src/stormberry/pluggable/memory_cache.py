@@ -0,0 +1,274 @@
+import logging
+import math
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+import stormberry.plugin
+from stormberry.plugin.manager import PluginTypeName, prepare_plugin
+from stormberry.util import aggregate_readings, extremes_of_readings, mean_of_readings, to_epoch
+from stormberry.weather_reading import WeatherReading
+
+
+class _RingBuffer():
+    '''
+    A fixed number of time ordered readings, kept column-wise in
+    preallocated arrays of doubles. Missing values are stored as NaN.
+    Once full, each new reading replaces the oldest one.
+    '''
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self._epochs = array('d', [0.0]) * capacity
+        self._columns = [array('d', [math.nan]) * capacity for i in range(width)]
+        self._start = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def epoch_at(self, index):
+        return self._epochs[(self._start + index) % self.capacity]
+
+    def values_at(self, index):
+        position = (self._start + index) % self.capacity
+        return tuple(
+                None if math.isnan(column[position]) else column[position]
+                for column in self._columns
+                )
+
+    def append(self, epoch, values):
+        if self._length > 0 and epoch < self.epoch_at(self._length - 1):
+            return False
+
+        position = (self._start + self._length) % self.capacity
+        if self._length == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._length += 1
+
+        self._epochs[position] = epoch
+        for column, value in zip(self._columns, values):
+            column[position] = math.nan if value is None else value
+
+        return True
+
+    def drop_before(self, epoch):
+        while self._length > 0 and self.epoch_at(0) < epoch:
+            self._start = (self._start + 1) % self.capacity
+            self._length -= 1
+
+    def bisect_left(self, epoch):
+        low, high = 0, self._length
+        while low < high:
+            middle = (low + high) // 2
+            if self.epoch_at(middle) < epoch:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def bisect_right(self, epoch):
+        low, high = 0, self._length
+        while low < high:
+            middle = (low + high) // 2
+            if self.epoch_at(middle) <= epoch:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+class MemoryCache(stormberry.plugin.IRepositoryPlugin):
+    '''
+    Keeps the most recent WINDOW_HOURS of readings in memory and
+    answers reads covered by that window from there. Older ranges are
+    passed to the BACKING_REPOSITORY, which the window is also loaded
+    from and, at most every REFRESH_INTERVAL seconds, topped up from.
+
+    Readings stored through this plugin only go to memory. Enable the
+    backing repository as well to keep them. The backing repository
+    is the one the station or server prepared, and is shut down by
+    them rather than here.
+    '''
+
+    def prepare(self, config, data_manager):
+        self.config = config
+        self.data_manager = data_manager
+        self.backing = None
+        self._lock = threading.RLock()
+
+        update_interval = config.getint('GENERAL', 'UPDATE_INTERVAL', fallback=10)
+        self.window = config.getfloat('MEMORY_CACHE', 'WINDOW_HOURS', fallback=24) * 3600
+        self.refresh_interval = config.getfloat('MEMORY_CACHE', 'REFRESH_INTERVAL', fallback=update_interval)
+        capacity = config.getint(
+                'MEMORY_CACHE',
+                'CAPACITY',
+                fallback=int(self.window / max(update_interval, 1) * 1.5) + 1
+                )
+
+        self._buffer = _RingBuffer(capacity, len(WeatherReading.RAW_FIELDS))
+        # Reads starting before this go to the backing repository
+        self._covered_from = math.inf
+        self._last_refresh = None
+
+        backing_name = config.get('MEMORY_CACHE', 'BACKING_REPOSITORY', fallback='')
+        if backing_name != '':
+            plugin_manager = data_manager.get_entity('plugin-manager')
+            plugin = None
+            if plugin_manager is not None:
+                plugin = plugin_manager.getPluginByName(backing_name, PluginTypeName.REPOSITORY)
+
+            if plugin is None:
+                logging.error("Memory cache backing repository %s was not found" % backing_name)
+            else:
+                self.backing = prepare_plugin(plugin, config, data_manager)
+                self._load_window()
+
+        return True
+
+    @property
+    def thread_safe(self):
+        # Memory is read under _lock, older ranges from the backing
+        # repository
+        return self.backing is None or self.backing.thread_safe
+
+    def store_reading(self, data):
+        with self._lock:
+            self._append(data)
+
+        return True
+
+    def get_latest(self):
+        with self._lock:
+            self._refresh()
+            if len(self._buffer) > 0:
+                return self._reading_at(len(self._buffer) - 1)
+
+        if self.backing is not None:
+            return self.backing.get_latest()
+
+        return None
+
+    def get_between(self, start_time, end_time = None):
+        readings = self._cached_between(start_time, end_time)
+        if readings is not None:
+            return readings
+
+        if self.backing is not None:
+            return self.backing.get_between(start_time, end_time)
+
+        return []
+
+    def iter_between(self, start_time, end_time = None):
+        readings = self._cached_between(start_time, end_time)
+        if readings is not None:
+            return iter(readings)
+
+        if self.backing is not None:
+            return self.backing.iter_between(start_time, end_time)
+
+        return iter([])
+
+    def get_mean_between(self, start_time, end_time = None):
+        readings = self._cached_between(start_time, end_time)
+        if readings is None:
+            if self.backing is not None:
+                return self.backing.get_mean_between(start_time, end_time)
+            return []
+
+        return mean_of_readings(readings)
+
+    def get_extremes_between(self, start_time, end_time = None):
+        readings = self._cached_between(start_time, end_time)
+        if readings is None:
+            if self.backing is not None:
+                return self.backing.get_extremes_between(start_time, end_time)
+            return []
+
+        return extremes_of_readings(readings)
+
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        readings = self._cached_between(start_time, end_time)
+        if readings is None:
+            if self.backing is not None:
+                return self.backing.get_aggregates_between(start_time, end_time, bucket_seconds)
+            return []
+
+        return aggregate_readings(readings, bucket_seconds, self.aggregate_fields)
+
+    def _cached_between(self, start_time, end_time):
+        '''
+        Returns the readings in the range from memory, or None if the
+        range starts before what memory covers.
+        '''
+        start = to_epoch(start_time)
+        end = to_epoch(end_time) if end_time is not None else math.inf
+
+        with self._lock:
+            self._refresh()
+            if self.backing is not None and start < self._covered_from:
+                return None
+
+            first = self._buffer.bisect_left(start)
+            last = self._buffer.bisect_right(end)
+            return [self._reading_at(i) for i in range(first, last)]
+
+    def _append(self, reading):
+        epoch = reading.timestamp.timestamp()
+
+        # A full buffer drops its oldest reading, so ranges reaching
+        # back to it can no longer be answered from memory
+        if len(self._buffer) == self._buffer.capacity:
+            dropped = self._buffer.epoch_at(0)
+        else:
+            dropped = None
+
+        if not self._buffer.append(epoch, reading.raw):
+            return
+
+        if dropped is not None:
+            self._covered_from = max(self._covered_from, dropped + 0.000001)
+
+        window_start = epoch - self.window
+        self._buffer.drop_before(window_start)
+        self._covered_from = max(self._covered_from, window_start)
+
+    def _load_window(self):
+        start = datetime.now() - timedelta(seconds=self.window)
+        with self._lock:
+            self._covered_from = start.timestamp()
+            for reading in self.backing.get_between(start):
+                self._append(reading)
+
+            self._last_refresh = time.monotonic()
+
+    def _refresh(self):
+        '''
+        Picks up readings the backing repository got from elsewhere
+        (usually the station) since the last refresh.
+        '''
+        if self.backing is None:
+            return
+
+        now = time.monotonic()
+        if self._last_refresh is not None and now - self._last_refresh < self.refresh_interval:
+            return
+
+        self._last_refresh = now
+        if len(self._buffer) > 0:
+            newest = self._buffer.epoch_at(len(self._buffer) - 1)
+        else:
+            newest = time.time() - self.window
+
+        for reading in self.backing.get_between(datetime.fromtimestamp(newest)):
+            if reading.timestamp.timestamp() > newest:
+                self._append(reading)
+
+    def _reading_at(self, index):
+        return WeatherReading.from_raw(
+                datetime.fromtimestamp(self._buffer.epoch_at(index)),
+                self._buffer.values_at(index)
+                )
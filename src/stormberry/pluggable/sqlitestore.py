@@ -1,42 +1,241 @@
+import contextlib
+import logging
+import queue
 import sqlite3
 import os
+import threading
+import time
+from urllib.request import pathname2url
 import stormberry.plugin
 from datetime import datetime
+from stormberry.config import Config
 from stormberry.weather_reading import WeatherReading
 
+class _ReadPool():
+    '''
+    Read-only connections to the database, each handed to one reader
+    at a time so concurrent server requests never share a cursor.
+    Up to size connections are opened on demand, after which readers
+    wait for one to be returned.
+    '''
+
+    def __init__(self, filename, size):
+        self._uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(filename))
+        self._size = size
+        self._opened = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self._checkout()
+        try:
+            yield db
+        finally:
+            if self._closed:
+                db.close()
+            else:
+                self._idle.put(db)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self._size:
+                self._opened += 1
+                return self._connect()
+
+        return self._idle.get()
+
+    def _connect(self):
+        db = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        db.execute("PRAGMA query_only = ON")
+        return db
+
+
 class SQLite3Store(stormberry.plugin.IRepositoryPlugin):
 
-    create_query = "CREATE TABLE IF NOT EXISTS weather_data(id INTEGER PRIMARY KEY ASC, timestr, tempc, inchesHg, humidity, dewpointc, pm_2_5, pm_10)"
-    insert_query = "INSERT INTO weather_data(timestr, tempc, inchesHg, humidity, dewpointc, pm_2_5, pm_10) VALUES (:timestr, :tempc, :inchesHg, :humidity, :dewpointc, :pm_2_5, :pm_10)"
+    # Each read checks out a connection of its own from _readers
+    thread_safe = True
+
+    # Bumped whenever the layout of the database changes. The version
+    # is kept in the database's user_version and _migrate brings older
+    # databases up to date when the plugin is prepared.
+    schema_version = 2
+
+    create_query = "CREATE TABLE IF NOT EXISTS weather_data(id INTEGER PRIMARY KEY ASC, timestr, tempc, inchesHg, humidity, dewpointc, pm_2_5, pm_10, epoch INTEGER)"
+    create_epoch_index_query = "CREATE INDEX IF NOT EXISTS weather_data_epoch ON weather_data(epoch)"
+    insert_query = "INSERT INTO weather_data(timestr, epoch, tempc, inchesHg, humidity, dewpointc, pm_2_5, pm_10) VALUES (:timestr, :epoch, :tempc, :inchesHg, :humidity, :dewpointc, :pm_2_5, :pm_10)"
+    select_columns = "id, epoch, timestr, tempc, inchesHg, humidity, pm_2_5, pm_10"
+
+    # Turns a Datetime() compatible time string into the epoch seconds
+    # stored for it. Reading times are local, hence the 'utc' modifier.
+    epoch_expression = "CAST(strftime('%s', {}, 'utc') AS INTEGER)"
+
+    # Rows backfilled per transaction while migrating, so the station
+    # and server can keep using the database during a long migration
+    migration_batch_size = 5000
+
+    # Rollup tables kept up to date as readings are stored, finest
+    # first. Aggregate queries read the coarsest one that their
+    # bucket width is a multiple of.
+    rollups = (
+            ('weather_rollup_minute', 60),
+            ('weather_rollup_hour', 3600),
+            ('weather_rollup_day', 86400),
+            )
+    rollup_suffixes = ('_sum', '_min', '_max', '_count', '_first', '_last')
+
+    # How _bucket_query reads raw readings and rollup rows. {0} is
+    # replaced by a field name.
+    raw_source = {
+            'table': 'weather_data',
+            'order': 'epoch',
+            'first_epoch': 'epoch',
+            'last_epoch': 'epoch',
+            'count': '1',
+            'sum': '{0}',
+            'min': '{0}',
+            'max': '{0}',
+            'field_count': '{0} IS NOT NULL',
+            'first': '{0}',
+            'last': '{0}'
+            }
+    rollup_source = {
+            'order': 'bucket',
+            'first_epoch': 'first_epoch',
+            'last_epoch': 'last_epoch',
+            'count': 'count',
+            'sum': '{0}_sum',
+            'min': '{0}_min',
+            'max': '{0}_max',
+            'field_count': '{0}_count',
+            'first': '{0}_first',
+            'last': '{0}_last'
+            }
+
+    # Config options holding how many days each table keeps its rows.
+    # Rows are kept forever when an option is missing or empty.
+    retention_options = (
+            ('weather_data', 'epoch', 0, 'RAW_RETENTION_DAYS'),
+            ('weather_rollup_minute', 'bucket', 60, 'MINUTE_RETENTION_DAYS'),
+            ('weather_rollup_hour', 'bucket', 3600, 'HOUR_RETENTION_DAYS'),
+            ('weather_rollup_day', 'bucket', 86400, 'DAY_RETENTION_DAYS'),
+            )
+
+    # Rows deleted per transaction and pages freed per incremental
+    # vacuum step while compacting
+    compact_batch_size = 1000
+    vacuum_batch_pages = 256
+
+    # Rows read per query by iter_between and iter_fields_between
+    stream_batch_size = 500
+
+    # The columns iter_fields_between selects for each field of a
+    # reading, and the WeatherReading arguments they're passed as
+    field_columns = {
+            'timestr': (),
+            'datetime': (),
+            'tempc': ('tempc',),
+            'tempf': ('tempc',),
+            'humidity': ('humidity',),
+            'inchesHg': ('inchesHg',),
+            'dewpointc': ('tempc', 'humidity'),
+            'dewpointf': ('tempc', 'humidity'),
+            'wind_mph': (),
+            'pm_2_5': ('pm_2_5',),
+            'pm_10': ('pm_10',),
+            'precipitation_cm': (),
+            'noise_dB': ()
+            }
+    column_arguments = {
+            'tempc': 'tempc',
+            'inchesHg': 'pressureInchesHg',
+            'humidity': 'humidity',
+            'pm_2_5': 'pm_2_5',
+            'pm_10': 'pm_10'
+            }
+
+    journal_modes = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    synchronous_levels = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
     def prepare(self, config, data_manager):
 
         self.config = config
         self.data_manager = data_manager
         self.db = None
+        self._write_lock = threading.Lock()
 
         try:
-            self.db = sqlite3.connect(config.get('SQLITE', 'FILENAME'))
+            # The station stores readings from its timer threads, so the
+            # connection can't be tied to the thread that prepared it.
+            # Writes are serialized with _write_lock instead.
+            self.db = sqlite3.connect(config.get('SQLITE', 'FILENAME'), check_same_thread=False)
         except:
             return False
 
-        self.cursor = self.db.cursor()
+        # Only takes effect on a new database, and only before the
+        # journal mode is changed. It lets compact() hand freed pages
+        # back to the filesystem.
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._configure_journal(self.db)
+        self._migrate(self.db)
+
+        if config.getboolean('SQLITE', 'CONVERT_AUTO_VACUUM', fallback=False):
+            self._convert_auto_vacuum()
+
+        self._rollup_insert_queries = [
+                self._rollup_insert_query(table, width) for table, width in self.rollups
+                ]
+
+        self._readers = _ReadPool(
+                config.get('SQLITE', 'FILENAME'),
+                config.getint('SQLITE', 'READ_CONNECTIONS', fallback=4)
+                )
+        return True
 
     def shutdown(self):
         if self.db is not None:
+            self._readers.close()
             self.db.close()
+            self.db = None
 
     def store_reading(self, data, first_time=False):
+        return self.store_readings([data])
+
+    def store_readings(self, readings):
 
-        filename = self.config.get('SQLITE', 'FILENAME')
+        if self.db is None:
+            return False
+
+        insert_data = [self._insert_data(reading) for reading in readings]
 
-        file_exists = os.path.exists(filename)
+        # sqlite3 caches compiled statements per connection, so reusing
+        # insert_query on the long-lived connection skips re-preparing it.
+        with self._write_lock:
+            self.db.executemany(self.insert_query, insert_data)
+            for query in self._rollup_insert_queries:
+                self.db.executemany(query, insert_data)
+            self.db.commit()
 
-        db = sqlite3.connect(filename)
-        db.execute(self.create_query)
+        return True
 
-        insert_data = {
+    def _insert_data(self, data):
+        return {
                 'timestr': data.timestr,
+                'epoch': int(data.timestamp.timestamp()),
                 'tempc' : data.tempc,
                 'dewpointc' : data.dewpointc,
                 'humidity' : data.humidity,
@@ -45,85 +244,642 @@ class SQLite3Store(stormberry.plugin.IRepositoryPlugin):
                 'pm_10': data.pm_10
                 }
 
-        db.execute(self.insert_query, insert_data)
+    def compact(self):
+        '''
+        Deletes rows older than their table's retention, a batch per
+        transaction. Raw readings are covered by the rollups, so with
+        e.g. RAW_RETENTION_DAYS=7 and MINUTE_RETENTION_DAYS=90 older
+        data stays available as minute (then hour, day) aggregates.
+        '''
+        if self.db is None:
+            return
+
+        now = int(time.time())
+        deleted = 0
+        for table, column, width, option in self.retention_options:
+            days = self.config.get('SQLITE', option, fallback='').strip()
+            if days == '':
+                continue
+
+            # A rollup row is only dropped once its whole bucket is
+            # past the retention
+            cutoff = now - int(float(days) * 86400) - width
+            query = "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE {1} < ? ORDER BY {1} LIMIT ?)".format(table, column)
+
+            while True:
+                with self._write_lock:
+                    removed = self.db.execute(query, (cutoff, self.compact_batch_size)).rowcount
+                    self.db.commit()
+
+                deleted += removed
+                if removed < self.compact_batch_size:
+                    break
+
+        if deleted > 0:
+            logging.info("Compacted %d rows from %s" % (deleted, self.config.get('SQLITE', 'FILENAME')))
+            self._incremental_vacuum()
+
+    def _convert_auto_vacuum(self):
+        '''
+        Turns on incremental auto_vacuum for a database created
+        without it. That takes a VACUUM, which rewrites the whole
+        file, so it's only done once.
+        '''
+        if self.db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+
+        logging.info("Vacuuming %s to enable auto_vacuum" % self.config.get('SQLITE', 'FILENAME'))
+        with self._write_lock:
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.db.execute("VACUUM")
+
+    def _incremental_vacuum(self):
+        # Databases created before auto_vacuum was enabled keep their
+        # free pages and reuse them for new readings instead, unless
+        # CONVERT_AUTO_VACUUM is set.
+        if self.db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return
+
+        while True:
+            with self._write_lock:
+                if self.db.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                    break
+                self.db.execute("PRAGMA incremental_vacuum(%d)" % self.vacuum_batch_pages).fetchall()
+                self.db.commit()
+
+    def _configure_journal(self, db):
+        journal_mode = self.config.get('SQLITE', 'JOURNAL_MODE', fallback='WAL').upper()
+        synchronous = self.config.get('SQLITE', 'SYNCHRONOUS', fallback='NORMAL').upper()
+
+        if journal_mode not in self.journal_modes:
+            raise ValueError("Unsupported SQLITE JOURNAL_MODE: %s" % journal_mode)
+
+        if synchronous not in self.synchronous_levels:
+            raise ValueError("Unsupported SQLITE SYNCHRONOUS level: %s" % synchronous)
+
+        db.execute("PRAGMA journal_mode=%s" % journal_mode)
+        db.execute("PRAGMA synchronous=%s" % synchronous)
+
+    def _migrate(self, db):
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        table_exists = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'weather_data'"
+                ).fetchone() is not None
+
+        if not table_exists:
+            db.execute(self.create_query)
+            db.execute(self.create_epoch_index_query)
+            self._create_rollups(db)
+            db.execute("PRAGMA user_version = %d" % self.schema_version)
+            db.commit()
+            return
+
+        if version < 1:
+            self._migrate_epoch_column(db)
+
+        if version < 2:
+            self._migrate_rollups(db)
+
+    def _migrate_epoch_column(self, db):
+        '''
+        Adds the indexed epoch column and backfills it from timestr.
+        The backfill walks the table in id ranges and commits after
+        each batch, so it can be interrupted and picked up again.
+        '''
+        logging.info("Migrating weather_data to schema version 1")
+
+        columns = [row[1] for row in db.execute("PRAGMA table_info(weather_data)")]
+        if 'epoch' not in columns:
+            try:
+                db.execute("ALTER TABLE weather_data ADD COLUMN epoch INTEGER")
+                db.commit()
+            except sqlite3.OperationalError as e:
+                # Another process (station or server) got there first
+                if 'duplicate column' not in str(e):
+                    raise
+
+        backfill_query = "UPDATE weather_data SET epoch = %s WHERE id > ? AND id <= ? AND epoch IS NULL" % (
+                self.epoch_expression.format('timestr'),
+                )
+
+        first_id, last_id = db.execute("SELECT MIN(id), MAX(id) FROM weather_data").fetchone()
+        if first_id is not None:
+            batch_start = first_id - 1
+            while batch_start < last_id:
+                batch_end = batch_start + self.migration_batch_size
+                with self._write_lock:
+                    db.execute(backfill_query, (batch_start, batch_end))
+                    db.commit()
+                batch_start = batch_end
+
+        db.execute(self.create_epoch_index_query)
+        db.execute("PRAGMA user_version = 1")
         db.commit()
-        db.close()
 
-        return True
+        logging.info("Migrated weather_data to schema version 1")
+
+    def _migrate_rollups(self, db):
+        logging.info("Migrating weather_data to schema version 2")
+
+        self._create_rollups(db)
+        db.commit()
+        self._backfill_rollups(db)
+
+        db.execute("PRAGMA user_version = 2")
+        db.commit()
+
+        logging.info("Migrated weather_data to schema version 2")
+
+    def _range_clause(self, start_time, end_time):
+        '''
+        Builds the WHERE clause and parameters selecting readings
+        between start_time and the optional end_time. Comparing on
+        the epoch column lets sqlite use its index.
+        '''
+        if end_time is None:
+            clause = "WHERE epoch >= %s" % self.epoch_expression.format('?')
+            return clause, (start_time,)
+
+        clause = "WHERE epoch >= %s AND epoch <= %s" % (
+                self.epoch_expression.format('?'),
+                self.epoch_expression.format('?')
+                )
+        return clause, (start_time, end_time)
+
+    def _clipped_rollup(self, db, table, width, start_time, end_time):
+        '''
+        Builds a subquery of rows shaped like a rollup table's that
+        covers start_time to the optional end_time: the rollup
+        buckets wholly inside the range, and at either end the finest
+        rows still stored, from a finer rollup or the readings
+        themselves. Where compaction has left no finer rows for part
+        of an end bucket, that part is left out rather than counting
+        readings from outside the range. Returns the subquery and its
+        parameters.
+        '''
+        start, end = db.execute(
+                "SELECT %s, %s" % (self.epoch_expression.format('?'), self.epoch_expression.format('?')),
+                (start_time, end_time)
+                ).fetchone()
+
+        sources = [('weather_data', 'epoch', 1)]
+        for rollup_table, rollup_width in self.rollups:
+            sources.append((rollup_table, 'bucket', rollup_width))
+            if rollup_table == table:
+                break
+
+        firsts = [db.execute("SELECT MIN(%s) FROM %s" % (column, source)).fetchone()[0] for source, column, w in sources]
+        ranges = [[] for source in sources]
+        self._cover(start, end + 1 if end is not None else None, len(sources) - 1, sources, firsts, ranges)
+
+        reading_columns = ["epoch", "epoch", "epoch", "1"]
+        for field in self.aggregate_fields:
+            reading_columns += [field, field, field, "%s IS NOT NULL" % field, field, field]
+
+        selects = []
+        params = ()
+        for (source, column, w), source_ranges in zip(sources, ranges):
+            if len(source_ranges) == 0:
+                continue
+
+            if w == 1:
+                columns = ", ".join("%s AS %s" % pair for pair in zip(reading_columns, self._rollup_columns()))
+            else:
+                columns = ", ".join(self._rollup_columns())
+
+            conditions = []
+            for lower, upper in source_ranges:
+                if upper is None:
+                    conditions.append("%s >= ?" % column)
+                    params += (lower,)
+                else:
+                    conditions.append("(%s >= ? AND %s < ?)" % (column, column))
+                    params += (lower, upper)
+
+            selects.append("SELECT %s FROM %s WHERE %s" % (columns, source, " OR ".join(conditions)))
+
+        if len(selects) == 0:
+            # Nothing stored for the range
+            selects.append("SELECT %s FROM %s WHERE 0" % (", ".join(self._rollup_columns()), table))
+
+        return "(%s)" % " UNION ALL ".join(selects), params
+
+    def _cover(self, lower, upper, level, sources, firsts, ranges):
+        '''
+        Adds to ranges the rows of sources[level] and those finer
+        that cover lower to upper (None for no end) without overlap.
+        This source takes its buckets that are wholly inside and not
+        all held by the finer source before it, and the rest is left
+        to that one. Rows a source doesn't have cost nothing to ask
+        for.
+        '''
+        if upper is not None and lower >= upper:
+            return
+
+        width = sources[level][2]
+        if level == 0:
+            ranges[0].append((lower, upper))
+            return
+
+        finer_from = firsts[level - 1]
+        inner_start = lower + (-lower) % width
+        # The first bucket the finer source holds all of
+        handoff = finer_from + (-finer_from) % width if finer_from is not None else None
+        if upper is not None:
+            inner_end = upper - upper % width
+            handoff = inner_end if handoff is None else min(handoff, inner_end)
+
+        if handoff is not None and handoff <= inner_start:
+            self._cover(lower, upper, level - 1, sources, firsts, ranges)
+            return
+
+        ranges[level].append((inner_start, handoff))
+        self._cover(lower, inner_start, level - 1, sources, firsts, ranges)
+        if handoff is not None:
+            self._cover(handoff, upper, level - 1, sources, firsts, ranges)
 
     def health_check(self):
         return os.access(self.config.get('SQLITE', 'FILENAME'), os.W_OK)
 
     def get_latest(self):
-        query = "SELECT * FROM weather_data ORDER BY ID DESC LIMIT 1"
-        self.cursor.execute(query)
-        return self._transform_db_row(self.cursor.fetchone())
+        query = "SELECT %s FROM weather_data ORDER BY id DESC LIMIT 1" % self.select_columns
+        with self._readers.connection() as db:
+            row = db.execute(query).fetchone()
+
+        if row is None:
+            return None
+
+        return self._transform_db_row(row)
 
     def get_between(self, start_time, end_time = None):
-        if end_time is None:
-            query = "SELECT * FROM weather_data WHERE timestr >= Datetime(?)"
-            self.cursor.execute(query, (start_time,))
-        else:
-            query = "SELECT * FROM weather_data WHERE timestr >= Datetime(?) AND timestr <= Datetime(?)"
-            self.cursor.execute(query, (start_time, end_time))
+        return list(self.iter_between(start_time, end_time))
 
-        readings = []
-        for row in self.cursor:
-            readings.append(self._transform_db_row(row))
+    def iter_between(self, start_time, end_time = None):
+        '''
+        Yields the readings as they're read from the database, a
+        batch at a time.
+        '''
+        for row in self._iter_rows(self.select_columns, start_time, end_time):
+            yield self._transform_db_row(row)
 
-        return readings
+    def iter_fields_between(self, start_time, end_time = None, fields = None, limit = None, cursor = None):
+        '''
+        Selects only the columns the fields are worked out from. The
+        cursors are the epoch and id of a reading, so continuing from
+        one seeks straight to it in the epoch index.
+        '''
+        if fields is None:
+            fields = list(self.field_columns)
+
+        columns = []
+        for field in fields:
+            for column in self.field_columns[field]:
+                if column not in columns:
+                    columns.append(column)
+
+        rows = self._iter_rows(", ".join(["id", "epoch", "timestr"] + columns), start_time, end_time, limit, cursor)
+        for row in rows:
+            arguments = dict((self.column_arguments[column], value) for column, value in zip(columns, row[3:]))
+            values = WeatherReading(date=self._row_timestamp(row), **arguments).dict
+            yield [row[1], row[0]], dict((field, values[field]) for field in fields)
+
+    def _iter_rows(self, columns, start_time, end_time, limit = None, cursor = None):
+        '''
+        Yields up to limit rows of columns, which start with id and
+        epoch, between the times in epoch and id order, continuing
+        after the (epoch, id) cursor if there is one. Each batch of
+        stream_batch_size rows is a query of its own, and the read
+        connection is given back in between, so a slow reader
+        doesn't keep it from everyone else.
+        '''
+        clause, params = self._range_clause(start_time, end_time)
+        query = "SELECT %s FROM weather_data %s" % (columns, clause)
+
+        while limit is None or limit > 0:
+            batch_size = self.stream_batch_size if limit is None else min(limit, self.stream_batch_size)
+            if cursor is None:
+                batch_query = query + " ORDER BY epoch, id LIMIT ?"
+                batch_params = params + (batch_size,)
+            else:
+                batch_query = query + " AND (epoch > ? OR (epoch = ? AND id > ?)) ORDER BY epoch, id LIMIT ?"
+                batch_params = params + (cursor[0], cursor[0], cursor[1], batch_size)
+
+            with self._readers.connection() as db:
+                rows = db.execute(batch_query, batch_params).fetchall()
+
+            for row in rows:
+                yield row
+
+            if len(rows) < batch_size:
+                return
+
+            cursor = (rows[-1][1], rows[-1][0])
+            if limit is not None:
+                limit -= len(rows)
 
     def get_mean_between(self, start_time, end_time = None):
-        if end_time is None:
-            query = "SELECT AVG(tempc), AVG(humidity), AVG(dewpointc), AVG(pm_2_5), AVG(pm_10) FROM weather_data WHERE timestr >= Datetime(?)"
-            self.cursor.execute(query, (start_time,))
-        else:
-            query = "SELECT AVG(tempc), AVG(humidity), AVG(dewpointc) FROM weather_data WHERE timestr >= Datetime(?) AND timestr <= Datetime(?)"
-            self.cursor.execute(query, (start_time, end_time))
-            result = self.cursor.fetchone()
+        summaries = self._summarize_between(start_time, end_time, ('tempc', 'humidity', 'dewpointc', 'pm_2_5', 'pm_10'))
+        means = dict(
+                (field, total / count if count else None)
+                for field, (total, count, minimum, maximum) in summaries.items()
+                )
 
         averages = {
-                'tempc_avg': result[0],
-                'humidity_avg': result[1],
-                'dewpointc_avg': result[2],
-                'pm2_5_avg': result[3],
-                'pm_10_avg': result[4],
+                'tempc_avg': means['tempc'],
+                'humidity_avg': means['humidity'],
+                'dewpointc_avg': means['dewpointc'],
+                'pm2_5_avg': means['pm_2_5'],
+                'pm_10_avg': means['pm_10'],
                 }
 
         return averages
 
     def get_extremes_between(self, start_time, end_time = None):
-        if end_time is None:
-            query = "SELECT MIN(tempc), MAX(tempc), MIN(humidity), MAX(humidity), MIN(dewpointc), MAX(dewpointc), MIN(pm_2_5), MAX(pm_2_5), MIN(pm_10), MAX(pm_10) FROM weather_data WHERE timestr >= Datetime(?)"
-            self.cursor.execute(query, (start_time,))
-        else:
-            query = "SELECT MIN(tempc), MAX(tempc), MIN(humidity), MAX(humidity), MIN(dewpointc), MAX(dewpointc), MIN(pm_2_5), MAX(pm_2_5), MIN(pm_10), MAX(pm_10) FROM weather_data WHERE timestr >= Datetime(?) AND timestr <= Datetime(?)"
-            self.cursor.execute(query, (start_time, end_time))
-            result = self.cursor.fetchone()
-
-        extremes = {
-                'tempc_min': result[0],
-                'tempc_max': result[1],
-                'humidity_min': result[2],
-                'humidity_max': result[3],
-                'dewpointc_min': result[4],
-                'dewpointc_max': result[5],
-                'pm_2_5_min': result[6],
-                'pm_2_5_max': result[7],
-                'pm_10_min': result[8],
-                'pm_10_max': result[9],
-                }
+        summaries = self._summarize_between(start_time, end_time, ('tempc', 'humidity', 'dewpointc', 'pm_2_5', 'pm_10'))
+
+        extremes = {}
+        for field, (total, count, minimum, maximum) in summaries.items():
+            extremes[field + '_min'] = minimum
+            extremes[field + '_max'] = maximum
 
         return extremes
 
+    def _summarize_between(self, start_time, end_time, fields):
+        '''
+        Works out the total, count, minimum and maximum of each field
+        for the readings between start_time and the optional
+        end_time. Where compaction has deleted the readings, the
+        finest rollup still holding them is used instead, so those
+        parts of the range are only as precise as its buckets.
+        '''
+        summaries = dict((field, [0.0, 0, None, None]) for field in fields)
+        sources = (('weather_data', 'epoch', 1),) + tuple((table, 'bucket', width) for table, width in self.rollups)
+
+        with self._readers.connection() as db:
+            start, end = db.execute(
+                    "SELECT %s, %s" % (self.epoch_expression.format('?'), self.epoch_expression.format('?')),
+                    (start_time, end_time)
+                    ).fetchone()
+            upper = end + 1 if end is not None else None
+
+            # From the raw readings back through coarser rollups, each
+            # source covering what the ones before it no longer hold
+            for i, (table, column, width) in enumerate(sources):
+                first = db.execute("SELECT MIN(%s) FROM %s" % (column, table)).fetchone()[0]
+                if first is None:
+                    continue
+
+                lower = start - start % width
+                if first > lower and i + 1 < len(sources):
+                    # Hand what's older on at the first boundary after
+                    # the oldest row that buckets of every width end at
+                    lower = first + (-first) % self.rollups[-1][1]
+                    if upper is not None:
+                        lower = min(lower, upper)
+
+                if width == 1:
+                    values = "TOTAL({0}), COUNT({0}), MIN({0}), MAX({0})"
+                else:
+                    values = "TOTAL({0}_sum), SUM({0}_count), MIN({0}_min), MAX({0}_max)"
+
+                clause = "WHERE %s >= ?" % column
+                params = (lower,)
+                if upper is not None:
+                    clause += " AND %s < ?" % column
+                    params += (upper,)
+
+                query = "SELECT %s FROM %s %s" % (", ".join(values.format(field) for field in fields), table, clause)
+                row = db.execute(query, params).fetchone()
+                for n, field in enumerate(fields):
+                    total, count, minimum, maximum = row[n * 4:n * 4 + 4]
+                    summary = summaries[field]
+                    summary[0] += total
+                    summary[1] += count or 0
+                    if minimum is not None:
+                        summary[2] = minimum if summary[2] is None else min(summary[2], minimum)
+                    if maximum is not None:
+                        summary[3] = maximum if summary[3] is None else max(summary[3], maximum)
+
+                if lower <= start:
+                    break
+
+                upper = lower if upper is None else min(upper, lower)
+
+        return summaries
+
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        # Read the coarsest rollup that buckets can be built from,
+        # falling back to the raw readings for odd bucket widths.
+        with self._readers.connection() as db:
+            for table, width in reversed(self.rollups):
+                if bucket_seconds % width == 0:
+                    source, params = self._clipped_rollup(db, table, width, start_time, end_time)
+                    query = self._bucket_query(dict(self.rollup_source, table=source), "")
+                    break
+            else:
+                clause, params = self._range_clause(start_time, end_time)
+                query = self._bucket_query(self.raw_source, clause)
+
+            rows = db.execute(query, (bucket_seconds,) + params + (bucket_seconds,))
+            return [self._transform_aggregate_row(row) for row in rows]
+
+    def rebuild_rollups(self):
+        '''
+        Builds the rollup rows again from the stored readings. Rollup
+        rows from before the oldest stored reading, whose readings
+        may have been compacted away, are kept as they are.
+        '''
+        self._backfill_rollups(self.db)
+
+    def _create_rollups(self, db):
+        for table, width in self.rollups:
+            columns = ['bucket INTEGER PRIMARY KEY', 'first_epoch INTEGER', 'last_epoch INTEGER', 'count INTEGER']
+            columns += self._rollup_field_columns()
+            db.execute("CREATE TABLE IF NOT EXISTS %s(%s)" % (table, ", ".join(columns)))
+
+    def _backfill_rollups(self, db):
+        '''
+        Rebuilds the rollup rows from the stored readings one day at a
+        time. Each day is replaced in a single transaction, so running
+        this again, or alongside a station storing readings, doesn't
+        count anything twice.
+
+        Only buckets starting at or after the oldest stored reading
+        are replaced. The bucket it falls in may hold readings that
+        compaction has since deleted, so it's only built if missing.
+        '''
+        first_epoch, last_epoch = db.execute("SELECT MIN(epoch), MAX(epoch) FROM weather_data").fetchone()
+        if first_epoch is None:
+            return
+
+        chunk_start = first_epoch - first_epoch % 86400
+        while chunk_start <= last_epoch:
+            chunk_end = chunk_start + 86400
+            with self._write_lock:
+                for table, width in self.rollups:
+                    covered_from = first_epoch + (-first_epoch) % width
+                    db.execute("DELETE FROM %s WHERE bucket >= ? AND bucket < ?" % table, (max(chunk_start, covered_from), chunk_end))
+                    query = "INSERT OR IGNORE INTO %s(%s) %s" % (
+                            table,
+                            ", ".join(self._rollup_columns()),
+                            self._bucket_query(self.raw_source, "WHERE epoch >= ? AND epoch < ?")
+                            )
+                    db.execute(query, (width, chunk_start, chunk_end, width))
+                db.commit()
+
+            chunk_start = chunk_end
+
+    def _rollup_columns(self):
+        columns = ['bucket', 'first_epoch', 'last_epoch', 'count']
+        for field in self.aggregate_fields:
+            columns += [field + suffix for suffix in self.rollup_suffixes]
+
+        return columns
+
+    def _rollup_field_columns(self):
+        return [column for column in self._rollup_columns() if column not in ('bucket', 'first_epoch', 'last_epoch', 'count')]
+
+    def _rollup_insert_query(self, table, width):
+        '''
+        Builds the statement that adds a single reading (named like
+        insert_query's parameters) to a rollup table.
+        '''
+        values = [":epoch - :epoch %% %d" % width, ":epoch", ":epoch", "1"]
+        for field in self.aggregate_fields:
+            values += [
+                    "IFNULL(:{0}, 0)".format(field),
+                    ":" + field,
+                    ":" + field,
+                    ":{0} IS NOT NULL".format(field),
+                    ":" + field,
+                    ":" + field
+                    ]
+
+        return "INSERT INTO %s(%s) VALUES (%s) %s" % (
+                table,
+                ", ".join(self._rollup_columns()),
+                ", ".join(values),
+                self._rollup_conflict_clause()
+                )
+
+    def _rollup_conflict_clause(self):
+        '''
+        Merges a new partial bucket into an existing rollup row. All
+        right hand sides see the row as it was before the update.
+        '''
+        updates = [
+                "first_epoch = MIN(first_epoch, excluded.first_epoch)",
+                "last_epoch = MAX(last_epoch, excluded.last_epoch)",
+                "count = count + excluded.count"
+                ]
+
+        for field in self.aggregate_fields:
+            updates += [
+                    "{0}_sum = {0}_sum + excluded.{0}_sum".format(field),
+                    "{0}_min = MIN(IFNULL({0}_min, excluded.{0}_min), IFNULL(excluded.{0}_min, {0}_min))".format(field),
+                    "{0}_max = MAX(IFNULL({0}_max, excluded.{0}_max), IFNULL(excluded.{0}_max, {0}_max))".format(field),
+                    "{0}_count = {0}_count + excluded.{0}_count".format(field),
+                    "{0}_first = CASE WHEN excluded.first_epoch < first_epoch THEN excluded.{0}_first ELSE {0}_first END".format(field),
+                    "{0}_last = CASE WHEN excluded.last_epoch >= last_epoch THEN excluded.{0}_last ELSE {0}_last END".format(field)
+                    ]
+
+        return "ON CONFLICT(bucket) DO UPDATE SET " + ", ".join(updates)
+
+    def _bucket_query(self, source, clause):
+        '''
+        Groups the rows of source (raw readings or a rollup table)
+        matching clause into buckets, producing rows laid out like the
+        rollup tables. The first and last value of each bucket come
+        from window functions over its rows in time order. Parameters
+        are the bucket width, the clause's parameters and the bucket
+        width again.
+        '''
+        outer_columns = []
+        inner_columns = []
+        for field in self.aggregate_fields:
+            outer_columns.append(
+                    "TOTAL({0}_s), MIN({0}_mn), MAX({0}_mx), SUM({0}_c), {0}_f, {0}_l".format(field)
+                    )
+            inner_columns.append(
+                    "{sum} AS {0}_s, {min} AS {0}_mn, {max} AS {0}_mx, {field_count} AS {0}_c, "
+                    "FIRST_VALUE({first}) OVER bucket_window AS {0}_f, "
+                    "LAST_VALUE({last}) OVER bucket_window AS {0}_l".format(
+                        field,
+                        sum=source['sum'].format(field),
+                        min=source['min'].format(field),
+                        max=source['max'].format(field),
+                        field_count=source['field_count'].format(field),
+                        first=source['first'].format(field),
+                        last=source['last'].format(field)
+                        )
+                    )
+
+        return (
+                "SELECT grp, MIN(fe), MAX(le), SUM(n), {outer} FROM ("
+                "SELECT {order} - {order} % ? AS grp, {first_epoch} AS fe, {last_epoch} AS le, {count} AS n, {inner} "
+                "FROM {table} {clause} "
+                "WINDOW bucket_window AS (PARTITION BY {order} - {order} % ? ORDER BY {order} "
+                "ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)"
+                ") GROUP BY grp ORDER BY grp"
+                ).format(
+                    outer=", ".join(outer_columns),
+                    inner=", ".join(inner_columns),
+                    clause=clause,
+                    **source
+                    )
+
+    def _transform_aggregate_row(self, row):
+        bucket_time = datetime.fromtimestamp(row[0])
+        bucket = {
+                'epoch': row[0],
+                'datetime': bucket_time,
+                'timestr': bucket_time.strftime("%Y-%m-%d %H:%M:%S"),
+                'count': row[3]
+                }
+
+        column = 4
+        for field in self.aggregate_fields:
+            total, minimum, maximum, count, first, last = row[column:column + 6]
+            bucket[field + '_avg'] = total / count if count else None
+            bucket[field + '_min'] = minimum
+            bucket[field + '_max'] = maximum
+            bucket[field + '_count'] = count
+            bucket[field + '_first'] = first
+            bucket[field + '_last'] = last
+            column += 6
+
+        return bucket
+
+    def _row_timestamp(self, row):
+        '''
+        The timestamp of a row selected starting with id, epoch and
+        timestr.
+        '''
+        if row[1] is not None:
+            return datetime.fromtimestamp(row[1])
+
+        # Not backfilled yet by a migration running elsewhere
+        return datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S')
+
     def _transform_db_row(self, row):
-        timestamp = datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S')
         return WeatherReading(
-                date=timestamp,
-                tempc=row[2],
-                pressureInchesHg=row[3],
-                humidity=row[4],
+                date=self._row_timestamp(row),
+                tempc=row[3],
+                pressureInchesHg=row[4],
+                humidity=row[5],
                 pm_2_5=row[6],
                 pm_10=row[7]
             )
 
+
+def rebuild_rollups():
+    '''
+    Console entry point that rebuilds the rollup tables of the
+    configured database from its stored readings.
+    '''
+    store = SQLite3Store()
+    if store.prepare(Config(), stormberry.plugin.PluginDataManager()) is False:
+        raise Exception("Unable to open the sqlite database")
+
+    store.rebuild_rollups()
+    store.shutdown()
@@ -1,40 +1,157 @@
-import urllib2
+import http.client
 import logging
+import threading
+import time
+from datetime import timezone
+from urllib.parse import urlencode, urlsplit
 import stormberry.plugin
-from urllib import urlencode
 
 
 class WundergroundUploader(stormberry.plugin.IRepositoryPlugin):
+    '''
+    Uploads readings to Weather Underground from a thread of its own
+    over one kept-alive connection, so the station never waits on it.
+    Uploads are at least UPLOAD_INTERVAL seconds apart; when readings
+    arrive faster than that, or while the site can't be reached, only
+    the latest is sent. With RAPID_FIRE on, readings go to the rapid
+    fire server, every 2.5 seconds by default.
+
+    See http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
+    '''
+
+    def prepare(self, config, data_manager):
+        self.config = config
+        self.data_manager = data_manager
+        self.station_id = self._setting('STATION_ID')
+        self.station_key = self._setting('STATION_KEY')
+        self.rapid_fire = config.getboolean('WUNDERGROUND', 'RAPID_FIRE', fallback=False)
+        self.timeout = config.getfloat('WUNDERGROUND', 'TIMEOUT', fallback=10)
+
+        if self.rapid_fire:
+            url = self._setting('RAPID_FIRE_URL', 'https://rtupdate.wunderground.com/weatherstation/updateweatherstation.php')
+            self.upload_interval = config.getfloat('WUNDERGROUND', 'UPLOAD_INTERVAL', fallback=2.5)
+        else:
+            url = self._setting('WU_URL')
+            self.upload_interval = config.getfloat('WUNDERGROUND', 'UPLOAD_INTERVAL', fallback=0)
+
+        url = urlsplit(url)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._host = url.hostname
+        self._port = url.port
+        self._path = url.path
+        self._connection = None
+
+        self._latest = None
+        self._last_upload = None
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._upload_latest, name="stormberry-wunderground", daemon=True)
+        self._thread.start()
+
+        return True
+
+    def shutdown(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+        self._thread.join(self.timeout)
 
     def store_reading(self, data):
-        """Internal. Continuously uploads new sensors values to Weather Underground."""
+        '''
+        Queues the reading to upload, in place of any not yet sent.
+        '''
+        with self._condition:
+            if self._latest is not None:
+                logging.debug("Weather Underground is behind. Skipping the reading from %s" % self._latest.timestr)
+
+            self._latest = data
+            self._condition.notify()
+
+        return True
+
+    def store_readings(self, readings):
+        if len(readings) > 0:
+            return self.store_reading(readings[-1])
+
+        return True
 
+    def _upload_latest(self):
+        backoff = 0
+        while True:
+            with self._condition:
+                while not self._stopping and self._latest is None:
+                    self._condition.wait()
 
-        print('Uploading data to Weather Underground')
+                # Keep to the upload interval, or the backoff after a
+                # failure, picking up newer readings while waiting
+                if self._last_upload is not None:
+                    wait_until = self._last_upload + max(self.upload_interval, backoff)
+                    while not self._stopping and time.monotonic() < wait_until:
+                        self._condition.wait(wait_until - time.monotonic())
 
-        # Build a weather data object http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
+                if self._stopping:
+                    break
+
+                data = self._latest
+                self._latest = None
+
+            self._last_upload = time.monotonic()
+            if self._upload(data):
+                backoff = 0
+                continue
+
+            backoff = min(60, max(1, backoff * 2))
+            with self._condition:
+                # Try again with it unless something newer came in
+                if self._latest is None:
+                    self._latest = data
+
+        if self._connection is not None:
+            self._connection.close()
+
+    def _upload(self, data):
         weather_data = {
             'action': 'updateraw',
-            'ID': self.config['WUNDERGROUND']['STATION_ID'],
-            'PASSWORD': self.config['WUNDERGROUND']['STATION_KEY'],
-            'dateutc': 'now',
+            'ID': self.station_id,
+            'PASSWORD': self.station_key,
+            'dateutc': data.timestamp.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
             'tempf': data.tempf,
             'humidity': data.humidity,
             'baromin': data.pressure_inHg,
             'dewptf': data.dewpointf
         }
 
+        if self.rapid_fire:
+            weather_data['realtime'] = 1
+            weather_data['rtfreq'] = self.upload_interval
+
+        weather_data = dict((key, value) for key, value in weather_data.items() if value is not None)
+
         try:
-            upload_url = self.config['WUNDERGROUND']['WU_URL'] + '?' + urlencode(weather_data)
-            response = urllib2.urlopen(upload_url)
-            html = response.read()
-            print('Server response: ', html)
-            # Close response object
-            response.close()
-            return True
-        except:
-            print('Could not upload to Weather Underground')
-            logging.warning('Could not upload to Weather Underground', exc_info=True)
+            if self._connection is None:
+                self._connection = self._connection_class(self._host, self._port, timeout=self.timeout)
+
+            self._connection.request('GET', self._path + '?' + urlencode(weather_data))
+            response = self._connection.getresponse()
+            body = response.read().decode('utf-8', 'replace').strip()
+        except (http.client.HTTPException, OSError) as e:
+            logging.warning('Could not upload to Weather Underground: %s' % str(e))
+            self._connection.close()
+            self._connection = None
             return False
 
+        if response.status != 200 or not body.startswith('success'):
+            logging.warning('Weather Underground rejected the reading from %s: %d %s' % (data.timestr, response.status, body))
+            return False
+
+        logging.debug('Uploaded the reading from %s to Weather Underground' % data.timestr)
+        return True
+
+    def _setting(self, name, fallback=None):
+        value = self.config.get('WUNDERGROUND', name, fallback=fallback)
+        if value is None:
+            return None
 
+        # Older configs quote these values
+        return value.strip().strip('\'"')
@@ -1,4 +1,7 @@
+import asyncio
+from datetime import datetime
 from yapsy.IPlugin import IPlugin
+from stormberry.util import aggregate_readings, parse_time
 
 class PluginDataManager():
     '''
@@ -28,6 +31,14 @@ class PluginDataManager():
 
 class IRepositoryPlugin(IPlugin):
 
+    # Reading fields summarized by get_aggregates_between
+    aggregate_fields = ('tempc', 'humidity', 'inchesHg', 'dewpointc', 'pm_2_5', 'pm_10')
+
+    # Whether the read methods can be called from several threads at
+    # once, as the server does. Reads from repositories that can't are
+    # made one at a time.
+    thread_safe = False
+
     def prepare(self, config, data_manager):
         '''
         Activate the plugin. This should set up whatever callbacks
@@ -54,6 +65,49 @@ class IRepositoryPlugin(IPlugin):
         '''
         return True
 
+    def store_readings(self, readings):
+        '''
+        Store several weather readings at once. Repositories that
+        can write a batch more cheaply than one reading at a time
+        should override this.
+
+        Returns:
+            True (all stored) or False (at least one failed)
+        '''
+        results = [self.store_reading(reading) for reading in readings]
+        return all(results)
+
+    async def async_store_reading(self, reading):
+        '''
+        Store a weather reading from the asyncio runtime. By
+        default this runs store_reading in the event loop's
+        executor; repositories with non-blocking I/O can
+        override it.
+
+        Returns:
+            True (success) or False (fail)
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, self.store_reading, reading)
+
+    def compact(self):
+        '''
+        Called periodically by the station to apply the repository's
+        retention policy, removing or thinning out old readings. This
+        should work in small steps so storing new readings isn't held
+        up for long.
+        '''
+        pass
+
+    def get_update_interval(self):
+        '''
+        How often, in seconds, the station should store a
+        reading here, rounded to a whole number of
+        UPDATE_INTERVALs. None stores every reading. A value
+        for the plugin's name in the INTERVALS config section
+        takes precedence.
+        '''
+        return None
+
     def get_health(self):
         '''
         Health check method. Returns True (healthy) or False (unhealth)
@@ -81,6 +135,62 @@ class IRepositoryPlugin(IPlugin):
         '''
         return []
 
+    def iter_between(self, start_time, end_time = None):
+        '''
+        Like get_between, but yields the readings one at a time.
+        Repositories that can read them as they go should override
+        it, so long ranges never have to be held in memory at once.
+
+        @param start_time string
+        @param end_time string
+        @return iterator
+        '''
+        return iter(self.get_between(start_time, end_time))
+
+    def iter_fields_between(self, start_time, end_time = None, fields = None, limit = None, cursor = None):
+        '''
+        Yields up to limit of the readings between a start and
+        optional end time as (cursor, values) pairs, values being a
+        dict of the reading's fields named in fields, or all of them.
+        Passing a cursor continues after the reading it came with.
+        Cursors are lists that can be turned into JSON and back.
+
+        The default implementation picks the fields out of
+        iter_between. Its cursors are the epoch of a reading and how
+        many readings before it had the same epoch. Repositories that
+        can read only some fields should override it.
+
+        @param start_time string
+        @param end_time string
+        @param fields []
+        @param limit int
+        @param cursor []
+        @return iterator
+        '''
+        if cursor is not None:
+            # Readings at the cursor's epoch are counted from the first
+            start_time = max(parse_time(start_time), datetime.fromtimestamp(cursor[0]))
+
+        previous = None
+        same = 0
+        count = 0
+        for reading in self.iter_between(start_time, end_time):
+            epoch = reading.timestamp.timestamp()
+            same = same + 1 if epoch == previous else 0
+            previous = epoch
+
+            if cursor is not None and (epoch, same) <= (cursor[0], cursor[1]):
+                continue
+            if limit is not None and count >= limit:
+                return
+
+            values = reading.dict
+            if fields is not None:
+                values = dict((field, values[field]) for field in fields)
+
+            count += 1
+            yield [epoch, same], values
+
     def get_mean_between(self, start_time, end_time = None):
         '''
         Gets the means for the readings between a start
@@ -105,6 +215,30 @@ class IRepositoryPlugin(IPlugin):
         '''
         return []
 
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        '''
+        Summarizes the readings between a start and optional
+        end time into buckets of bucket_seconds, aligned to the
+        epoch. Each bucket is a dict with its start 'epoch',
+        'datetime' and 'timestr', the reading 'count', and for
+        every field in aggregate_fields the _avg, _min, _max,
+        _count, _first and _last values.
+
+        The default implementation aggregates get_between in
+        Python. Repositories that can summarize closer to the
+        data should override it.
+
+        @param start_time string
+        @param end_time string
+        @param bucket_seconds int
+        @return []
+        '''
+        return aggregate_readings(
+                self.get_between(start_time, end_time),
+                bucket_seconds,
+                self.aggregate_fields
+                )
+
 
 class ISensorPlugin(IPlugin):
 
@@ -145,6 +279,28 @@ class ISensorPlugin(IPlugin):
         '''
         return None
 
+    async def async_get_reading(self):
+        '''
+        Assemble and return a weather reading in the asyncio
+        runtime. By default this runs get_reading in the event
+        loop's executor; sensors with non-blocking I/O can
+        override it.
+
+        Returns:
+            WeatherReading or None
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_reading)
+
+    def get_update_interval(self):
+        '''
+        How often, in seconds, the sensor should be read,
+        rounded to a whole number of SAMPLE_INTERVALs. Between
+        reads, the station reuses its last reading. None reads
+        it every SAMPLE_INTERVAL. A value for the plugin's name
+        in the INTERVALS config section takes precedence.
+        '''
+        return None
+
     def get_health(self):
         '''
         Health check method. Returns True (healthy) or False (unhealth)
@@ -169,3 +325,16 @@ class IDisplayPlugin(IPlugin):
     def update(self, weather_reading):
         return True
 
+    async def async_update(self, weather_reading):
+        '''
+        update for the asyncio runtime, run in the event loop's
+        executor unless overridden.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, self.update, weather_reading)
+
+    def get_update_interval(self):
+        '''
+        Seconds between updates, as for
+        IRepositoryPlugin.get_update_interval.
+        '''
+        return None
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import threading
+import time
+
+
+class BufferedRepository():
+    '''
+    Wraps a repository plugin object and collects readings for it,
+    handing them over in one store_readings call once max_size
+    readings are waiting or the oldest has waited max_age seconds.
+    Reads go straight to the repository, so they don't see readings
+    still waiting in the buffer.
+    '''
+
+    def __init__(self, repository, max_size, max_age):
+        self.repository = repository
+        self.max_size = max_size
+        self.max_age = max_age
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        # Held while a batch is taken and stored, so batches reach the
+        # repository one at a time and in order
+        self._store_lock = threading.Lock()
+
+    def store_reading(self, reading):
+        with self._lock:
+            self._pending.append(reading)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+            if not self._due():
+                return True
+
+        return self._flush(self._due)
+
+    async def async_store_reading(self, reading):
+        return await asyncio.get_running_loop().run_in_executor(None, self.store_reading, reading)
+
+    def flush(self):
+        '''
+        Stores whatever is waiting, regardless of size or age.
+        '''
+        return self._flush(lambda: True)
+
+    def flush_if_stale(self):
+        '''
+        Stores whatever is waiting if the oldest reading has waited
+        max_age seconds, for when no new reading comes in to do it.
+        '''
+        return self._flush(self._stale)
+
+    def _due(self):
+        return len(self._pending) >= self.max_size or self._stale()
+
+    def _stale(self):
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+
+    def _flush(self, due):
+        '''
+        Stores what's waiting if due() still says so once it's this
+        call's turn, as another may have stored it in the meantime.
+        '''
+        with self._store_lock:
+            with self._lock:
+                if len(self._pending) == 0 or not due():
+                    return True
+
+                batch = self._take_pending()
+
+            return self._store(batch)
+
+    def shutdown(self):
+        self.flush()
+        self.repository.shutdown()
+
+    def _take_pending(self):
+        batch = self._pending
+        self._pending = []
+        self._oldest = None
+        return batch
+
+    def _store(self, batch):
+        try:
+            stored = self.repository.store_readings(batch)
+        except Exception as e:
+            logging.warning("Error storing %d buffered readings in %s: %s" % (
+                len(batch), self.repository.__class__.__name__, str(e)))
+            return False
+
+        if not stored:
+            logging.warning("Unable to store %d buffered readings in %s" % (
+                len(batch), self.repository.__class__.__name__))
+
+        return stored
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
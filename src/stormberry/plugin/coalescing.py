@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import Future
+
+
+class CoalescingRepository():
+    '''
+    Wraps a repository plugin object so that identical reads made at
+    the same time, from different server threads for instance, share
+    one call to the repository and its result. Callers that arrive
+    while a read is running wait for it instead of starting their own.
+    Results are shared between the callers, so they shouldn't be
+    changed. Writes, and reads that hand back an iterator, are made
+    on the repository for each caller.
+    '''
+
+    def __init__(self, repository):
+        self.repository = repository
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def get_latest(self):
+        return self._coalesce('get_latest')
+
+    def get_between(self, start_time, end_time = None):
+        return self._coalesce('get_between', start_time, end_time)
+
+    def get_mean_between(self, start_time, end_time = None):
+        return self._coalesce('get_mean_between', start_time, end_time)
+
+    def get_extremes_between(self, start_time, end_time = None):
+        return self._coalesce('get_extremes_between', start_time, end_time)
+
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        return self._coalesce('get_aggregates_between', start_time, end_time, bucket_seconds)
+
+    def _coalesce(self, name, *args):
+        key = (name,) + args
+        try:
+            hash(key)
+        except TypeError:
+            return getattr(self.repository, name)(*args)
+
+        with self._lock:
+            call = self._calls.get(key)
+            running = call is not None
+            if not running:
+                call = Future()
+                self._calls[key] = call
+
+        if running:
+            return call.result()
+
+        try:
+            result = getattr(self.repository, name)(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
@@ -22,3 +22,32 @@ def get_plugin_manager(config):
     plugin_manager.collectPlugins()
 
     return plugin_manager
+
+def prepare_plugin(plugin, config, data_manager):
+    '''
+    Prepares a plugin unless it already has been with this data
+    manager, and returns its plugin object. This lets a plugin that
+    reads from another one (like the memory cache from its backing
+    repository) share the object everything else uses.
+    '''
+    prepared = data_manager.get_entity('prepared-plugins')
+    if prepared is None:
+        prepared = []
+        data_manager.store_entity('prepared-plugins', prepared)
+
+    if plugin.plugin_object not in prepared:
+        plugin.plugin_object.prepare(config, data_manager)
+        prepared.append(plugin.plugin_object)
+
+    return plugin.plugin_object
+
+def shutdown_plugin(plugin_object, data_manager):
+    '''
+    Shuts down a plugin prepared by prepare_plugin, so it's prepared
+    again if it's asked for later.
+    '''
+    plugin_object.shutdown()
+
+    prepared = data_manager.get_entity('prepared-plugins')
+    if prepared is not None and plugin_object in prepared:
+        prepared.remove(plugin_object)
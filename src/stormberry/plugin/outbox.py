@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from stormberry.weather_reading import WeatherReading
+
+
+class OutboxRepository():
+    '''
+    Wraps a repository plugin object, usually one that uploads
+    somewhere, so storing a reading only appends it to a journal on
+    disk. A background thread hands journalled readings to the
+    repository in batches of up to batch_size through store_readings,
+    backing off exponentially, up to max_backoff seconds, while it
+    fails. How far it got is kept next to the journal, so whatever
+    wasn't stored before a restart is sent afterwards. The journal is
+    synced to disk at most every sync_interval seconds, after every
+    batch by default, so readings survive a power cut as well.
+
+    A batch is retried whole, so a repository that stored part of it
+    before failing may see some readings twice. Reads and compaction
+    are made on the repository itself, which only has the readings
+    drained to it so far.
+    '''
+
+    def __init__(self, repository, directory, name, batch_size=50, initial_backoff=1, max_backoff=300, sync_interval=0):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.sync_interval = sync_interval
+        self.name = name
+        self.directory = directory
+
+        os.makedirs(directory, exist_ok=True)
+        filename = "".join(c if c.isalnum() else "_" for c in name)
+        self.journal_path = os.path.join(directory, filename + ".journal")
+        self.offset_path = os.path.join(directory, filename + ".offset")
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._journal = open(self.journal_path, 'ab')
+        self._last_sync = time.monotonic()
+        self._offset = self._read_offset()
+        # Start by sending whatever was left from last time
+        self._wakeup.set()
+        self._thread = threading.Thread(target=self._drain, name="stormberry-outbox-" + filename, daemon=True)
+        self._thread.start()
+
+    def store_reading(self, reading):
+        return self.store_readings([reading])
+
+    def store_readings(self, readings):
+        lines = b"".join(
+                (json.dumps([reading.timestamp.isoformat(), list(reading.raw)]) + "\n").encode("utf-8")
+                for reading in readings
+                )
+
+        with self._lock:
+            self._journal.write(lines)
+            self._journal.flush()
+
+            if time.monotonic() - self._last_sync >= self.sync_interval:
+                os.fsync(self._journal.fileno())
+                self._last_sync = time.monotonic()
+
+        self._wakeup.set()
+        return True
+
+    async def async_store_reading(self, reading):
+        return self.store_reading(reading)
+
+    def pending(self):
+        '''
+        How many bytes of journal are still to be stored.
+        '''
+        with self._lock:
+            return os.path.getsize(self.journal_path) - self._offset
+
+    def stop(self, timeout=5):
+        '''
+        Stops draining, waiting up to timeout seconds for a batch
+        being stored. Anything not yet stored stays in the journal
+        for next time.
+        '''
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+
+        with self._lock:
+            if not self._journal.closed:
+                os.fsync(self._journal.fileno())
+                self._journal.close()
+
+    def shutdown(self):
+        self.stop()
+        self.repository.shutdown()
+
+    def _drain(self):
+        backoff = 0
+        while not self._stopping.is_set():
+            if backoff > 0:
+                self._stopping.wait(backoff)
+            else:
+                self._wakeup.wait()
+            self._wakeup.clear()
+
+            while not self._stopping.is_set():
+                readings, end = self._read_batch()
+                if end == self._offset:
+                    backoff = 0
+                    self._truncate_if_drained()
+                    break
+
+                if len(readings) > 0 and not self._store(readings):
+                    backoff = min(self.max_backoff, max(self.initial_backoff, backoff * 2))
+                    logging.warning("%s outbox will retry %d reading(s) in %s seconds" % (
+                        self.name, len(readings), backoff))
+                    break
+
+                backoff = 0
+                with self._lock:
+                    self._offset = end
+                    self._write_offset()
+
+    def _store(self, readings):
+        try:
+            return self.repository.store_readings(readings)
+        except Exception as e:
+            logging.warning("Error storing outbox readings in %s: %s" % (self.name, str(e)))
+            return False
+
+    def _read_batch(self):
+        '''
+        Reads up to batch_size complete journal lines from the
+        offset, returning the readings and the offset after them.
+        '''
+        readings = []
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self._offset)
+            end = self._offset
+
+            for line in journal:
+                if len(readings) >= self.batch_size or not line.endswith(b"\n"):
+                    break
+
+                end += len(line)
+                try:
+                    timestr, raw = json.loads(line.decode("utf-8"))
+                    readings.append(WeatherReading.from_raw(datetime.fromisoformat(timestr), raw))
+                except ValueError as e:
+                    logging.error("Skipping unreadable %s outbox entry: %s" % (self.name, str(e)))
+
+        return readings, end
+
+    def _truncate_if_drained(self):
+        with self._lock:
+            if self._offset > 0 and self._offset == os.path.getsize(self.journal_path):
+                self._journal.truncate(0)
+                os.fsync(self._journal.fileno())
+                self._offset = 0
+                self._write_offset()
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                offset = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+        # The journal may have been truncated after the offset was
+        # written
+        return min(offset, os.path.getsize(self.journal_path))
+
+    def _write_offset(self):
+        '''
+        Replaces the offset file, syncing it and then the directory
+        so a power cut leaves either the old offset or the new one.
+        '''
+        with open(self.offset_path + ".tmp", 'w') as f:
+            f.write(str(self._offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(self.offset_path + ".tmp", self.offset_path)
+
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
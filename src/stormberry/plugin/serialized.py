@@ -0,0 +1,49 @@
+import threading
+
+
+class SerializedRepository():
+    '''
+    Wraps a repository plugin object that can't be read from several
+    threads at once, so that its reads are made one at a time. Ranges
+    are read in full before they're handed back, as an iterator can't
+    hold the lock while its caller works through it.
+    '''
+
+    def __init__(self, repository):
+        self.repository = repository
+        self._lock = threading.RLock()
+
+    def get_latest(self):
+        with self._lock:
+            return self.repository.get_latest()
+
+    def get_between(self, start_time, end_time = None):
+        with self._lock:
+            return self.repository.get_between(start_time, end_time)
+
+    def iter_between(self, start_time, end_time = None):
+        with self._lock:
+            return iter(list(self.repository.iter_between(start_time, end_time)))
+
+    def iter_fields_between(self, start_time, end_time = None, fields = None, limit = None, cursor = None):
+        with self._lock:
+            return iter(list(self.repository.iter_fields_between(start_time, end_time, fields, limit, cursor)))
+
+    def get_mean_between(self, start_time, end_time = None):
+        with self._lock:
+            return self.repository.get_mean_between(start_time, end_time)
+
+    def get_extremes_between(self, start_time, end_time = None):
+        with self._lock:
+            return self.repository.get_extremes_between(start_time, end_time)
+
+    def get_aggregates_between(self, start_time, end_time = None, bucket_seconds = 3600):
+        with self._lock:
+            return self.repository.get_aggregates_between(start_time, end_time, bucket_seconds)
+
+    def shutdown(self):
+        with self._lock:
+            self.repository.shutdown()
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
@@ -1,10 +1,12 @@
 from flask import jsonify, request, Blueprint
 from stormberry.interpreter import WeatherInterpreter
 from stormberry.server.util import get_repository
+from stormberry.server.cache import cached_response
 
 comfort_blueprint = Blueprint('comfort_blueprint', __name__)
 
 @comfort_blueprint.route('/now')
+@cached_response
 def comfort_now():
     repo = get_repository()
     interpreter = WeatherInterpreter(repo)
@@ -1,12 +1,14 @@
 from flask import jsonify, request, Blueprint
 import datetime
 from stormberry.server.util import get_repository
+from stormberry.server.cache import cached_response
 from stormberry.forecast import WeatherForecaster
 
 forecast_blueprint = Blueprint('forecast_blueprint', __name__)
 
 
 @forecast_blueprint.route('/basic')
+@cached_response
 def basic_prediction():
     now = datetime.datetime.now()
     ago = now - datetime.timedelta(days=1)
@@ -4,6 +4,7 @@ import stormberry.util
 from stormberry.util import weather_list_to_dict_list
 from stormberry.server.util import get_repository
 from stormberry.interpreter import WeatherInterpreter
+from stormberry.weather_reading import WeatherReading
 
 grafana_blueprint = Blueprint('grafana_blueprint', __name__)
 
@@ -27,6 +28,24 @@ def transform_readings_to_series(readings, fields=None):
 
     return transformed
 
+def aggregates_to_readings(buckets):
+    '''
+    Turns repository aggregate buckets into one reading per bucket
+    holding the bucket's means, so derived values like tempf and the
+    dewpoints are worked out the same way as for stored readings.
+    '''
+    return [
+            WeatherReading(
+                date=b['datetime'],
+                tempc=b['tempc_avg'],
+                humidity=b['humidity_avg'],
+                pressureInchesHg=b['inchesHg_avg'],
+                pm_2_5=b['pm_2_5_avg'],
+                pm_10=b['pm_10_avg']
+                )
+            for b in buckets
+            ]
+
 @grafana_blueprint.route('/')
 def grafana_health():
     return jsonify({})
@@ -54,7 +73,15 @@ def grafana_query():
 
     reply_data = []
 
-    weather_readings = repo.get_between(req['range']['from'], req['range']['to'])
+    if 'intervalMs' in req:
+        # Grafana sends the interval between points it can actually
+        # draw, so let the repository summarize down to that.
+        bucket_seconds = max(1, int(req['intervalMs']) // 1000)
+        weather_readings = aggregates_to_readings(
+                repo.get_aggregates_between(req['range']['from'], req['range']['to'], bucket_seconds)
+                )
+    else:
+        weather_readings = repo.get_between(req['range']['from'], req['range']['to'])
     readings = transform_readings_to_series(weather_readings)
     interpreter = WeatherInterpreter(repo)
     comfort = interpreter.comfort_safety()
@@ -1,13 +1,142 @@
-from flask import Flask, jsonify, send_from_directory, request, Blueprint
+from flask import Flask, Response, current_app, jsonify, send_from_directory, request, Blueprint, stream_with_context
+import base64
+import binascii
 import datetime
 import stormberry.util
-from stormberry.util import weather_list_to_dict_list
 from stormberry.server.util import get_repository
+from stormberry.server.cache import cached_response
+from stormberry.weather_reading import WeatherReading
 import json
 
 weather_blueprint = Blueprint('weather_blueprint', __name__)
 
+# Readings serialized per chunk of a streamed response
+STREAM_CHUNK_SIZE = 100
+
+def stream_readings(readings):
+    '''
+    Streams reading dicts as they come as a JSON array, or as one
+    JSON object per line if the request asks for ?format=ndjson, so a
+    long range is never held in memory at once.
+    '''
+    ndjson = request.args.get('format') == 'ndjson'
+    dumps = current_app.json.dumps
+
+    def generate():
+        chunk = []
+        separator = "\n" if ndjson else ","
+        started = False
+
+        if not ndjson:
+            yield "["
+
+        for reading in readings:
+            chunk.append(dumps(reading))
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield (separator if started else "") + separator.join(chunk)
+                started = True
+                chunk = []
+
+        if len(chunk) > 0:
+            yield (separator if started else "") + separator.join(chunk)
+            started = True
+
+        if not ndjson:
+            yield "]"
+        elif started:
+            yield "\n"
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def readings_between(start_date, end_date = None):
+    '''
+    Responds with the readings from start_date until the optional
+    end_date. They can be narrowed down to a comma separated list of
+    ?fields, which always includes timestr, and paged through ?limit
+    at a time. When there are more, the X-Next-Cursor header has the
+    ?cursor to pass to carry on from the last one.
+    '''
+    repo = get_repository()
+
+    if not any(arg in request.args for arg in ('fields', 'limit', 'cursor')):
+        return stream_readings(reading.dict for reading in repo.iter_between(start_date, end_date))
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        limit = parse_limit(request.args.get('limit'))
+        cursor = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if limit is None:
+        rows = repo.iter_fields_between(start_date, end_date, fields, None, cursor)
+        return stream_readings(values for position, values in rows)
+
+    # One more than the limit says whether there's another page
+    page = list(repo.iter_fields_between(start_date, end_date, fields, limit + 1, cursor))
+    response = stream_readings(values for position, values in page[:limit])
+    if len(page) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(page[limit - 1][0])
+
+    return response
+
+def parse_fields(value):
+    if value is None:
+        return None
+
+    fields = ['timestr']
+    known = WeatherReading().fields
+    for field in value.split(','):
+        field = field.strip()
+        if field == '' or field in fields:
+            continue
+        if field not in known:
+            raise ValueError("Unknown field %s" % field)
+
+        fields.append(field)
+
+    return fields
+
+def parse_limit(value):
+    if value is None:
+        return None
+
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    return limit
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_cursor(value):
+    if value is None:
+        return None
+
+    try:
+        position = json.loads(base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(position, list) or len(position) != 2:
+        raise ValueError("Invalid cursor")
+
+    for value in position:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("Invalid cursor")
+
+    try:
+        # The first is the epoch of a reading
+        datetime.datetime.fromtimestamp(position[0])
+    except (OverflowError, OSError):
+        raise ValueError("Invalid cursor")
+
+    return position
+
 @weather_blueprint.route('/latest-reading')
+@cached_response
 def latest_reading():
     repo = get_repository()
     latest = repo.get_latest()
@@ -15,17 +144,11 @@ def latest_reading():
 
 @weather_blueprint.route('/since/<start_date>')
 def weather_since(start_date):
-    repo = get_repository()
-
-    readings = repo.get_between(start_date)
-    return jsonify(weather_list_to_dict_list(readings))
+    return readings_between(start_date)
 
 @weather_blueprint.route('/since/<start_date>/until/<end_date>')
 def weather_between(start_date, end_date):
-    repo = get_repository()
-
-    readings = repo.get_between(start_date, end_date)
-    return jsonify(weather_list_to_dict_list(readings))
+    return readings_between(start_date, end_date)
 
 @weather_blueprint.route('/past-hour')
 def weather_past_hour():
@@ -34,8 +157,7 @@ def weather_past_hour():
 
     repo = get_repository()
     datestr = ago.strftime("%Y-%m-%d %H:%M:%S")
-    readings = repo.get_between(datestr)
-    return jsonify(weather_list_to_dict_list(readings))
+    return stream_readings(reading.dict for reading in repo.iter_between(datestr))
 
 @weather_blueprint.route('/past-day')
 def weather_past_day():
@@ -44,8 +166,7 @@ def weather_past_day():
 
     repo = get_repository()
     datestr = ago.strftime("%Y-%m-%d %H:%M:%S")
-    readings = repo.get_between(datestr)
-    return jsonify(weather_list_to_dict_list(readings))
+    return stream_readings(reading.dict for reading in repo.iter_between(datestr))
 
 @weather_blueprint.route('/past-week')
 def weather_past_week():
@@ -54,6 +175,5 @@ def weather_past_week():
     repo = get_repository()
     datestr = ago.strftime("%Y-%m-%d %H:%M:%S")
 
-    readings = repo.get_between(datestr)
-    return jsonify(weather_list_to_dict_list(readings))
+    return stream_readings(reading.dict for reading in repo.iter_between(datestr))
 
@@ -0,0 +1,152 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, make_response, request
+
+from stormberry.config import Config
+from stormberry.server.util import get_repository
+
+
+class ResponseCache():
+    '''
+    Least recently used cache of up to max_entries computed values.
+    Everything in it is dropped when the timestamp returned by
+    latest_timestamp changes, which is checked at most every
+    check_interval seconds, and values are recomputed once they're
+    ttl seconds old regardless.
+    '''
+
+    def __init__(self, latest_timestamp, max_entries=128, ttl=60, check_interval=1):
+        self.latest_timestamp = latest_timestamp
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._latest = None
+        self._checked = None
+
+    def get(self, key, compute, cacheable=None):
+        '''
+        Returns the value cached for key, calling compute for it if
+        there isn't one. It's only kept if cacheable, when given,
+        says it should be.
+        '''
+        now = time.monotonic()
+        self._check_latest(now)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+            generation = self._generation
+
+        value = compute()
+        if cacheable is not None and not cacheable(value):
+            return value
+
+        with self._lock:
+            # Unless a newer reading came in while computing it
+            if generation == self._generation:
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._invalidate()
+
+    def _invalidate(self):
+        self._entries.clear()
+        self._generation += 1
+
+    def _check_latest(self, now):
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.check_interval:
+                return
+
+            self._checked = now
+
+        latest = self.latest_timestamp()
+
+        with self._lock:
+            if latest != self._latest:
+                self._latest = latest
+                self._invalidate()
+
+
+_lock = threading.Lock()
+_cache = None
+_pid = None
+
+
+def get_response_cache():
+    '''
+    Returns this process's response cache, or None if CACHE_SIZE is 0.
+    '''
+    global _cache, _pid
+
+    with _lock:
+        if _pid != os.getpid():
+            config = Config()
+            size = config.getint("SERVER", "CACHE_SIZE", fallback=128)
+            _cache = None
+            if size > 0:
+                _cache = ResponseCache(
+                        _latest_timestamp,
+                        size,
+                        config.getfloat("SERVER", "CACHE_TTL", fallback=60),
+                        config.getfloat("SERVER", "CACHE_CHECK_INTERVAL", fallback=1)
+                        )
+            _pid = os.getpid()
+
+        return _cache
+
+
+def cached_response(view):
+    '''
+    Decorates a view so its successful responses are served from the
+    response cache, by endpoint, view arguments and query string,
+    until a new reading is stored.
+    '''
+    @functools.wraps(view)
+    def cached_view(*args, **kwargs):
+        cache = get_response_cache()
+        if cache is None:
+            return view(*args, **kwargs)
+
+        key = (
+                request.endpoint,
+                args,
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True)))
+                )
+
+        body, status, headers = cache.get(
+                key,
+                lambda: _freeze(make_response(view(*args, **kwargs))),
+                lambda frozen: frozen[1] == 200
+                )
+
+        return current_app.response_class(body, status=status, headers=headers)
+
+    return cached_view
+
+
+def _freeze(response):
+    return response.get_data(), response.status_code, list(response.headers.items())
+
+
+def _latest_timestamp():
+    latest = get_repository().get_latest()
+    return latest.timestamp if latest is not None else None
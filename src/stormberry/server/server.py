@@ -6,6 +6,8 @@ from stormberry.server.api.weather import weather_blueprint
 from stormberry.server.api.forecast import forecast_blueprint
 from stormberry.server.api.comfort import comfort_blueprint
 from stormberry.server.api.pollution import pollution_blueprint
+from stormberry.plugin.coalescing import CoalescingRepository
+from stormberry.plugin.serialized import SerializedRepository
 from stormberry.server.util import get_repository
 from stormberry.config import Config
 import stormberry.logging
@@ -53,5 +55,7 @@ def demo():
     app.logger.info("Starting stormberry-server")
 
     repository = get_repository()
+    while isinstance(repository, (CoalescingRepository, SerializedRepository)):
+        repository = repository.repository
     app.logger.info("Using storage plugin %s" % repository.__class__.__name__)
     app.run(port=port, host='0.0.0.0')
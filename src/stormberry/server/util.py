@@ -1,27 +1,95 @@
+import atexit
+import os
+import threading
+
 from stormberry.plugin import PluginDataManager
-from stormberry.plugin.manager import PluginTypeName, get_plugin_manager
+from stormberry.plugin.coalescing import CoalescingRepository
+from stormberry.plugin.serialized import SerializedRepository
+from stormberry.plugin.manager import PluginTypeName, get_plugin_manager, prepare_plugin, shutdown_plugin
 from stormberry.config import Config
 
-def get_repository():
-    repository = None
 
-    config = Config()
-    plugin_manager = get_plugin_manager(config)
-    plugin_data_manager = PluginDataManager()
+class RepositoryRegistry():
+    '''
+    Process-wide holder for the server's data source. Plugin discovery and
+    preparation happen once per worker process instead of on every request,
+    and the prepared repository is shut down when the process exits.
+    Identical reads from concurrent requests share one repository call,
+    and repositories that aren't thread safe are read one call at a time.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._repository = None
+        self._data_manager = None
+        self._pid = None
+
+    def get_repository(self):
+        '''
+        Returns the prepared repository for this process, loading
+        it on first use. A forked worker does not reuse the parent's
+        repository (and its open connections), it loads its own.
+        '''
+        repository = self._repository
+        if repository is not None and self._pid == os.getpid():
+            return repository
+
+        with self._lock:
+            if self._repository is None or self._pid != os.getpid():
+                repository = self._load_repository()
+                if not repository.thread_safe:
+                    repository = SerializedRepository(repository)
+
+                self._repository = CoalescingRepository(repository)
+                self._pid = os.getpid()
+
+            return self._repository
+
+    def close(self):
+        with self._lock:
+            if self._repository is not None and self._pid == os.getpid():
+                # Along with any repository it reads from
+                for plugin_object in list(self._data_manager.get_entity('prepared-plugins')):
+                    shutdown_plugin(plugin_object, self._data_manager)
 
-    try:
-        preferred_repo = config.get("GENERAL", "SERVER_DATA_SOURCE")
-        repository = plugin_manager.getPluginByName(preferred_repo, PluginTypeName.REPOSITORY).plugin_object
-        repository.prepare(config, plugin_data_manager)
-    except:
-        for p in plugin_manager.getPluginsOfCategory(PluginTypeName.REPOSITORY):
-            p.plugin_object.prepare(config, plugin_data_manager)
-            if p.plugin_object.get_latest() is not None:
-                repository = p.plugin_object
-                break
+            self._repository = None
+            self._data_manager = None
+            self._pid = None
 
-    if repository is None:
-        raise Exception("No acceptable data source found")
+    def _load_repository(self):
+        repository = None
 
-    return repository
+        config = Config()
+        plugin_manager = get_plugin_manager(config)
+        plugin_data_manager = PluginDataManager()
+        plugin_data_manager.store_entity('plugin-manager', plugin_manager)
+        self._data_manager = plugin_data_manager
 
+        try:
+            preferred_repo = config.get("GENERAL", "SERVER_DATA_SOURCE")
+            repository = prepare_plugin(
+                    plugin_manager.getPluginByName(preferred_repo, PluginTypeName.REPOSITORY),
+                    config,
+                    plugin_data_manager
+                    )
+        except:
+            for p in plugin_manager.getPluginsOfCategory(PluginTypeName.REPOSITORY):
+                prepare_plugin(p, config, plugin_data_manager)
+                if p.plugin_object.get_latest() is not None:
+                    repository = p.plugin_object
+                    break
+
+                shutdown_plugin(p.plugin_object, plugin_data_manager)
+
+        if repository is None:
+            raise Exception("No acceptable data source found")
+
+        return repository
+
+
+_registry = RepositoryRegistry()
+atexit.register(_registry.close)
+
+
+def get_repository():
+    return _registry.get_repository()
@@ -1,4 +1,8 @@
 from collections import deque
+import statistics
+import threading
+
+from stormberry.weather_reading import WeatherReading
 
 
 class Smoother():
@@ -19,3 +23,82 @@ class Smoother():
             self._last_data.appendleft(value)
 
         return sum(self._last_data) / self._size
+
+
+class ReadingAccumulator():
+    '''
+    Combines the weather readings taken over a window into one, field
+    by field, as the mean, median, min or max of the values that were
+    present. Only the median keeps the values themselves; the others
+    are worked out as readings arrive.
+    '''
+
+    methods = ('mean', 'median', 'min', 'max')
+
+    def __init__(self, method='mean'):
+        if method not in self.methods:
+            raise ValueError("Unknown aggregation method %s" % method)
+
+        self.method = method
+        self._lock = threading.Lock()
+        self._start()
+
+    def __len__(self):
+        return self._samples
+
+    def add(self, reading):
+        with self._lock:
+            self._samples += 1
+            self._timestamp = reading.timestamp
+
+            for i, value in enumerate(reading.raw):
+                if value is None:
+                    continue
+
+                if self.method == 'median':
+                    self._values[i].append(value)
+                elif self._values[i] is None:
+                    self._values[i] = value
+                elif self.method == 'mean':
+                    self._values[i] += value
+                elif self.method == 'min':
+                    self._values[i] = min(self._values[i], value)
+                else:
+                    self._values[i] = max(self._values[i], value)
+
+                self._counts[i] += 1
+
+    def result(self):
+        '''
+        Returns the combined reading, timed at the last reading added,
+        and starts a new window. None if nothing was added.
+        '''
+        with self._lock:
+            if self._samples == 0:
+                return None
+
+            values = []
+            for value, count in zip(self._values, self._counts):
+                if count == 0:
+                    values.append(None)
+                elif self.method == 'mean':
+                    values.append(value / count)
+                elif self.method == 'median':
+                    values.append(statistics.median(value))
+                else:
+                    values.append(value)
+
+            reading = WeatherReading.from_raw(self._timestamp, values)
+            self._start()
+
+        return reading
+
+    def _start(self):
+        fields = len(WeatherReading.RAW_FIELDS)
+        self._samples = 0
+        self._timestamp = None
+        self._counts = [0] * fields
+        if self.method == 'median':
+            self._values = [[] for i in range(fields)]
+        else:
+            self._values = [None] * fields
@@ -1,4 +1,4 @@
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import datetime
 import logging
@@ -8,7 +8,12 @@ import time
 
 from stormberry.config import Config
 from stormberry.plugin import PluginDataManager
-from stormberry.plugin.manager import PluginTypeName, get_plugin_manager
+from stormberry.plugin.buffered import BufferedRepository
+from stormberry.plugin.manager import PluginTypeName, get_plugin_manager, prepare_plugin
+from stormberry.plugin.outbox import OutboxRepository
+from stormberry.station.scheduler import Scheduler
+from stormberry.station.sinks import SinkWorker
+from stormberry.smoother import ReadingAccumulator
 from stormberry.weather_reading import WeatherReading
 
 
@@ -16,82 +21,291 @@ class WeatherStation():
 
     def __init__(self, plugin_manager=None, config=None, plugin_data_manager=None, log=None):
 
-        self._periodic_timer = None
         self.log = log if log is not None else logging
         self.config = config if config is not None else Config()
         self.plugin_data_manager = plugin_data_manager if plugin_data_manager is not None else PluginDataManager()
         self.plugin_manager = plugin_manager if plugin_manager is not None else get_plugin_manager(self.config)
+        if self.plugin_data_manager.get_entity('plugin-manager') is None:
+            # For plugins that use other plugins
+            self.plugin_data_manager.store_entity('plugin-manager', self.plugin_manager)
         self._latest_reading = None
+        self.repositories = []
+        self._repository_sinks = []
+        self._display_sinks = []
+        self._sensor_executor = None
+        self._sensor_futures = {}
+        self._sensor_readings = {}
+        self._scheduler = Scheduler(self.log)
+        self._accumulator = None
+        # Ticks between updates, and the tick of the last update, by
+        # plugin object or sink
+        self._every = {}
+        self._last_ticks = {}
 
     def prepare_sensors(self):
         for sensor in self.plugin_manager.getPluginsOfCategory(PluginTypeName.SENSOR):
             sensor.plugin_object.prepare(self.config, self.plugin_data_manager)
+            self._every[sensor.plugin_object] = self._ticks_between_updates(sensor, self._sample_interval())
 
     def prepare_repositories(self):
+        buffer_size = self.config.getint("GENERAL", "WRITE_BUFFER_SIZE", fallback=1)
+        buffer_age = self.config.getint("GENERAL", "WRITE_BUFFER_MAX_AGE", fallback=60)
+        outboxes = [
+                name.strip()
+                for name in self.config.get("OUTBOX", "REPOSITORIES", fallback="").split(",")
+                if name.strip() != ""
+                ]
+
+        self.repositories = []
+        self._repository_sinks = []
         for repo in self.plugin_manager.getPluginsOfCategory(PluginTypeName.REPOSITORY):
-            repo.plugin_object.prepare(self.config, self.plugin_data_manager)
+            prepare_plugin(repo, self.config, self.plugin_data_manager)
+
+            if repo.name in outboxes:
+                repository = OutboxRepository(
+                        repo.plugin_object,
+                        self.config.get("OUTBOX", "DIRECTORY", fallback="stormberry-outbox"),
+                        repo.name,
+                        self.config.getint("OUTBOX", "BATCH_SIZE", fallback=50),
+                        max_backoff=self.config.getint("OUTBOX", "MAX_BACKOFF", fallback=300),
+                        sync_interval=self.config.getfloat("OUTBOX", "SYNC_INTERVAL", fallback=0)
+                        )
+            elif buffer_size > 1:
+                repository = BufferedRepository(repo.plugin_object, buffer_size, buffer_age)
+            else:
+                repository = repo.plugin_object
+
+            sink = self._start_sink(repo.name, repository, "store_reading")
+            self._every[sink] = self._ticks_between_updates(repo, self.config.getint("GENERAL", "UPDATE_INTERVAL"))
+            self.repositories.append(repository)
+            self._repository_sinks.append(sink)
 
     def prepare_displays(self):
         if self.config.getboolean("GENERAL", "ENABLE_DISPLAY"):
             for display in self.plugin_manager.getPluginsOfCategory(PluginTypeName.DISPLAY):
                 display.plugin_object.prepare(self.config, self.plugin_data_manager)
+                sink = self._start_sink(display.name, display.plugin_object, "update")
+                self._every[sink] = self._ticks_between_updates(display, self.config.getint("GENERAL", "UPDATE_INTERVAL"))
+                self._display_sinks.append(sink)
 
     def start_station(self):
         """Launches multiple threads to handle configured behavior."""
-        self._periodic_callback()
+        update_interval = self.config.getint("GENERAL", "UPDATE_INTERVAL")
+        sample_interval = self._sample_interval()
+
+        if sample_interval < update_interval:
+            # Oversample, and report what was sampled over each
+            # interval once it has passed
+            self._accumulator = ReadingAccumulator(self.config.get("GENERAL", "SAMPLE_AGGREGATION", fallback="mean"))
+            self._scheduler.add_job("samples", sample_interval, self._sample_callback)
+            self._scheduler.add_job("readings", update_interval, self._periodic_callback, update_interval)
+        else:
+            self._scheduler.add_job("readings", update_interval, self._periodic_callback)
+
+        if any(isinstance(repo, BufferedRepository) for repo in self.repositories):
+            # Often enough that nothing waits much past its max age
+            buffer_age = self.config.getint("GENERAL", "WRITE_BUFFER_MAX_AGE", fallback=60)
+            self._scheduler.add_job("buffers", max(1, buffer_age / 10), self._flush_callback)
+
+        compact_interval = self.config.getint("GENERAL", "COMPACT_INTERVAL", fallback=3600)
+        if compact_interval > 0:
+            self._scheduler.add_job("compaction", compact_interval, self._compact_callback, compact_interval)
+
+        self._scheduler.start()
 
     def stop_station(self, *arg):
         """Tries to stop active threads and clean up screen."""
+        self._scheduler.stop(self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5))
+
+        if self._sensor_executor:
+            # A sensor stuck in a read shouldn't hold up the shutdown
+            self._sensor_executor.shutdown(wait=False)
+
+        sink_timeout = self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5)
+        for sink in self._display_sinks + self._repository_sinks:
+            sink.stop(sink_timeout)
+
+        for repo in self.repositories:
+            if isinstance(repo, BufferedRepository):
+                repo.flush()
+            elif isinstance(repo, OutboxRepository):
+                repo.stop(sink_timeout)
+
         for plugin in self.plugin_manager.getAllPlugins():
             plugin.plugin_object.shutdown()
 
-        if self._periodic_timer:
-            self._periodic_timer.cancel()
+    def take_reading(self, tick=None):
+        """
+        Reads every sensor at once and merges the results, in plugin
+        order, from the sensors that answered within SENSOR_TIMEOUT
+        seconds. A sensor that is still busy with an earlier reading
+        is skipped.
 
-    def take_reading(self):
+        Given the scheduler tick, sensors with a longer interval that
+        aren't due are left alone and their last reading is used.
+        """
         final_reading = WeatherReading()
+        timeout = self.config.getfloat("GENERAL", "SENSOR_TIMEOUT", fallback=self._sample_interval())
+
+        if self._sensor_executor is None:
+            self._sensor_executor = ThreadPoolExecutor(
+                    max_workers=self.config.getint("GENERAL", "SENSOR_THREADS", fallback=4),
+                    thread_name_prefix="stormberry-sensor"
+                    )
 
+        pending = []
         for sensor in self.plugin_manager.getPluginsOfCategory(PluginTypeName.SENSOR):
+            sensor_name = str(sensor.plugin_object.__class__.__name__)
+            if not self._due(sensor.plugin_object, tick):
+                pending.append((sensor_name, sensor.plugin_object, None))
+                continue
+
             if self._latest_reading is not None and not sensor.plugin_object.in_operating_range(self._latest_reading):
-                self.log.info("Sensor plugin %s reports we're outside operating range. Skipping." % str(sensor.plugin_object.__class__.__name__))
+                self.log.info("Sensor plugin %s reports we're outside operating range. Skipping." % sensor_name)
+                continue
+
+            previous = self._sensor_futures.get(sensor.plugin_object)
+            if previous is not None and not previous.done():
+                self.log.warning("Sensor plugin %s is still taking its last reading. Skipping." % sensor_name)
+                continue
+
+            future = self._sensor_executor.submit(sensor.plugin_object.get_reading)
+            self._sensor_futures[sensor.plugin_object] = future
+            pending.append((sensor_name, sensor.plugin_object, future))
+
+        deadline = time.monotonic() + timeout
+        for sensor_name, sensor, future in pending:
+            if future is None:
+                reading = self._sensor_readings.get(sensor)
+                if reading is not None:
+                    final_reading.merge(reading)
+                continue
+
+            try:
+                reading = future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                self.log.warning("Sensor plugin %s didn't respond within %s seconds. Leaving it out of this reading." % (sensor_name, timeout))
+                continue
+            except Exception as e:
+                self.log.error("Sensor plugin %s failed to take a reading: %s" % (sensor_name, str(e)))
                 continue
 
-            reading = sensor.plugin_object.get_reading()
+            self._sensor_readings[sensor] = reading
             if reading is not None:
                 final_reading.merge(reading)
 
         self.log.debug("New reading: " + str(final_reading))
         return final_reading
 
-    def report_reading(self, reading):
+    def report_reading(self, reading, tick=None):
+        """
+        Hands the reading to every display and repository at once, and
+        waits up to SINK_TIMEOUT seconds for them. Any still working
+        after that carry on in the background, and aren't waited for
+        again until they've caught up.
 
-        if self.config.getboolean("GENERAL", "ENABLE_DISPLAY"):
-            for display in self.plugin_manager.getPluginsOfCategory(PluginTypeName.DISPLAY):
-                display.plugin_object.update(reading)
+        Given the scheduler tick, only those due an update get it.
+        """
+        sinks = list(self._display_sinks)
 
-        if self._latest_reading is None and self.config.getboolean("GENERAL", "DISCARD_FIRST_READING"):
-            return
+        if self._latest_reading is not None or not self.config.getboolean("GENERAL", "DISCARD_FIRST_READING"):
+            sinks += self._repository_sinks
 
-        for repo in self.plugin_manager.getPluginsOfCategory(PluginTypeName.REPOSITORY):
-            repo.plugin_object.store_reading(reading)
+        sinks = [sink for sink in sinks if self._due(sink, tick)]
 
-    def _periodic_callback(self):
+        pending = []
+        for sink in sinks:
+            caught_up = sink.idle
+            future = sink.submit(reading)
+            if caught_up:
+                pending.append((sink, future))
 
-        wr = self.take_reading()
-        self.report_reading(wr)
+        timeout = self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5)
+        deadline = time.monotonic() + timeout
+        for sink, future in pending:
+            try:
+                future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                self.log.warning("%s is taking longer than %s seconds. Carrying on without it." % (sink.name, timeout))
+            except Exception:
+                # Already logged and counted by the sink
+                pass
+
+    def _periodic_callback(self, tick):
+
+        if self._accumulator is not None:
+            wr = self._accumulator.result()
+            if wr is None:
+                self.log.warning("No samples were taken in the last update interval. Nothing to report.")
+                return
+        else:
+            wr = self.take_reading(tick)
+
+        self.report_reading(wr, tick)
 
         self._latest_reading = wr
 
-        self._periodic_timer = self._start_timer(self.config.getint("GENERAL", "UPDATE_INTERVAL"), self._periodic_callback)
+    def _sample_callback(self, tick):
+        """Internal. Takes a sample to go into the next reading."""
+
+        self._accumulator.add(self.take_reading(tick))
+
+    def _flush_callback(self, tick=None):
+        """Internal. Stores buffered readings that have waited too long."""
+
+        for repo in self.repositories:
+            if isinstance(repo, BufferedRepository):
+                repo.flush_if_stale()
+
+    def _compact_callback(self, tick=None):
+        """Internal. Lets each repository apply its retention policy."""
+
+        for repo in self.repositories:
+            try:
+                repo.compact()
+            except Exception as e:
+                self.log.error("Compacting repository plugin %s failed: %s" % (repo.__class__.__name__, str(e)))
+
+    def _sample_interval(self):
+        """Internal. Seconds between sensor readings."""
+
+        return self.config.getfloat("GENERAL", "SAMPLE_INTERVAL", fallback=self.config.getint("GENERAL", "UPDATE_INTERVAL"))
+
+    def _ticks_between_updates(self, plugin, base_interval):
+        """Internal. How many base_intervals apart a plugin wants updates."""
+
+        interval = self.config.getfloat("INTERVALS", plugin.name, fallback=None)
+        if interval is None:
+            interval = plugin.plugin_object.get_update_interval()
+
+        if interval is None:
+            return 1
+
+        return max(1, int(round(interval / base_interval)))
+
+    def _due(self, key, tick):
+        """Internal. Whether a plugin or sink is due an update at this tick."""
+
+        if tick is None:
+            return True
+
+        last_tick = self._last_ticks.get(key)
+        if last_tick is not None and tick - last_tick < self._every.get(key, 1):
+            return False
 
-    def _start_timer(self, interval, callback):
-        """Internal. Starts timer with given interval and callback function."""
+        self._last_ticks[key] = tick
+        return True
 
-        timer = Timer(interval, callback)
-        timer.daemon = True
-        timer.start()
+    def _start_sink(self, name, target, method):
+        """Internal. Starts a worker thread feeding readings to target.method."""
 
-        return timer
+        return SinkWorker(
+                name,
+                getattr(target, method),
+                self.config.getint("GENERAL", "SINK_QUEUE_SIZE", fallback=360),
+                self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5),
+                self.log
+                )
 
     def _get_cpu_temp(self):
         """"
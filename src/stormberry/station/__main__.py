@@ -1,8 +1,10 @@
 from stormberry.config import Config
+import asyncio
 import signal
 import sys
 import stormberry.logging
 from stormberry.station import WeatherStation
+from stormberry.station.aio import AsyncWeatherStation
 from stormberry.plugin import ISensorPlugin, IRepositoryPlugin, IDisplayPlugin, PluginDataManager
 from stormberry.plugin.manager import get_plugin_manager
 
@@ -44,8 +46,12 @@ def main():
     stormberry_logger.info("Loaded %d plugins: %s" % (len(plugins), plugin_names))
 
     plugin_data_manager = PluginDataManager()
+    runtime = config.get("GENERAL", "RUNTIME", fallback="threads")
     try:
-        station = WeatherStation(plugin_manager, config, plugin_data_manager, stormberry_logger)
+        if runtime == "asyncio":
+            station = AsyncWeatherStation(plugin_manager, config, plugin_data_manager, stormberry_logger)
+        else:
+            station = WeatherStation(plugin_manager, config, plugin_data_manager, stormberry_logger)
 
         station.prepare_sensors()
         station.prepare_repositories()
@@ -54,9 +60,13 @@ def main():
         stormberry_logger.info('Successfully initialized sensors')
 
         with SignalHandling(station) as sh:
-            station.start_station()
-            stormberry_logger.info('Weather Station successfully launched')
-            signal.pause()
+            if runtime == "asyncio":
+                stormberry_logger.info('Weather Station launching on asyncio')
+                asyncio.run(station.run())
+            else:
+                station.start_station()
+                stormberry_logger.info('Weather Station successfully launched')
+                signal.pause()
 
     except Exception as e:
         stormberry_logger.critical(e)
@@ -0,0 +1,273 @@
+import asyncio
+import time
+
+from stormberry.plugin.buffered import BufferedRepository
+from stormberry.plugin.manager import PluginTypeName
+from stormberry.plugin.outbox import OutboxRepository
+from stormberry.station import WeatherStation
+from stormberry.station.scheduler import Scheduler
+from stormberry.station.sinks import SinkWorker
+from stormberry.weather_reading import WeatherReading
+
+
+class AsyncScheduler(Scheduler):
+    '''
+    A Scheduler that runs coroutine jobs as tasks on the running event
+    loop, on the same fixed ticks.
+    '''
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        for name, interval, callback, delay in self._jobs:
+            self._threads.append(loop.create_task(self._run(name, interval, callback, start + delay)))
+
+    def stop(self, timeout=None):
+        for task in self._threads:
+            task.cancel()
+
+        self._threads = []
+
+    async def _run(self, name, interval, callback, first):
+        loop = asyncio.get_running_loop()
+        tick = 0
+        while True:
+            await asyncio.sleep(max(0, first + tick * interval - loop.time()))
+            try:
+                await callback(tick)
+            except Exception as e:
+                self.log.error("Scheduled %s failed: %s" % (name, str(e)))
+
+            tick = self._next_tick(name, interval, first, tick, loop.time())
+
+
+class AsyncSinkWorker(SinkWorker):
+    '''
+    A SinkWorker that awaits a coroutine handler in a task on the
+    event loop instead of calling it on a thread.
+    '''
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self, timeout=None):
+        # There's no thread to join, and stopping has to wait on the
+        # event loop
+        raise RuntimeError("%s runs on the event loop. Await async_stop instead." % self.name)
+
+    async def async_stop(self, timeout=None):
+        '''
+        Lets the sink finish what's queued, waiting up to timeout
+        seconds.
+        '''
+        if self._task is None:
+            return
+
+        self._queue.put_nowait(None)
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _start(self):
+        # Both are made in start, on the event loop
+        self._queue = None
+        self._task = None
+
+    def _new_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            if job is None:
+                return
+
+            reading, future = job
+            if future.cancelled():
+                continue
+
+            self._handling = True
+            started = time.monotonic()
+            try:
+                result = await self.handler(reading)
+            except Exception as e:
+                self._handling = False
+                self._finished(reading, future, None, e, time.monotonic() - started)
+                continue
+
+            self._handling = False
+            self._finished(reading, future, result, None, time.monotonic() - started)
+
+
+class AsyncWeatherStation(WeatherStation):
+    '''
+    Runs the station on an asyncio event loop, using the async_
+    variants of the plugin hooks. Plugins that only implement the
+    blocking hooks are run in the loop's executor by the defaults in
+    stormberry.plugin, so both kinds can be mixed.
+
+    Call run() with asyncio.run; stop_station can be called from a
+    signal handler.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._scheduler = AsyncScheduler(self.log)
+        self._loop = None
+        self._stop_requested = None
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_requested = asyncio.Event()
+
+        for sink in self._display_sinks + self._repository_sinks:
+            sink.start()
+
+        self.start_station()
+        await self._stop_requested.wait()
+        await self._shutdown()
+
+    def stop_station(self, *arg):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_requested.set)
+
+    async def take_reading(self, tick=None):
+        """
+        Reads every sensor at once, as WeatherStation.take_reading, but
+        with async_get_reading.
+        """
+        final_reading = WeatherReading()
+        timeout = self.config.getfloat("GENERAL", "SENSOR_TIMEOUT", fallback=self._sample_interval())
+
+        pending = []
+        for sensor in self.plugin_manager.getPluginsOfCategory(PluginTypeName.SENSOR):
+            sensor_name = str(sensor.plugin_object.__class__.__name__)
+            if not self._due(sensor.plugin_object, tick):
+                pending.append((sensor_name, sensor.plugin_object, None))
+                continue
+
+            if self._latest_reading is not None and not sensor.plugin_object.in_operating_range(self._latest_reading):
+                self.log.info("Sensor plugin %s reports we're outside operating range. Skipping." % sensor_name)
+                continue
+
+            previous = self._sensor_futures.get(sensor.plugin_object)
+            if previous is not None and not previous.done():
+                self.log.warning("Sensor plugin %s is still taking its last reading. Skipping." % sensor_name)
+                continue
+
+            task = self._loop.create_task(sensor.plugin_object.async_get_reading())
+            self._sensor_futures[sensor.plugin_object] = task
+            pending.append((sensor_name, sensor.plugin_object, task))
+
+        deadline = self._loop.time() + timeout
+        for sensor_name, sensor, task in pending:
+            if task is None:
+                reading = self._sensor_readings.get(sensor)
+                if reading is not None:
+                    final_reading.merge(reading)
+                continue
+
+            try:
+                # Shielded so a late sensor keeps its task, and is
+                # skipped until it finishes
+                reading = await asyncio.wait_for(asyncio.shield(task), max(0, deadline - self._loop.time()))
+            except asyncio.TimeoutError:
+                self.log.warning("Sensor plugin %s didn't respond within %s seconds. Leaving it out of this reading." % (sensor_name, timeout))
+                continue
+            except Exception as e:
+                self.log.error("Sensor plugin %s failed to take a reading: %s" % (sensor_name, str(e)))
+                continue
+
+            self._sensor_readings[sensor] = reading
+            if reading is not None:
+                final_reading.merge(reading)
+
+        self.log.debug("New reading: " + str(final_reading))
+        return final_reading
+
+    async def report_reading(self, reading, tick=None):
+        """
+        Hands the reading to every display and repository at once, as
+        WeatherStation.report_reading.
+        """
+        sinks = list(self._display_sinks)
+
+        if self._latest_reading is not None or not self.config.getboolean("GENERAL", "DISCARD_FIRST_READING"):
+            sinks += self._repository_sinks
+
+        pending = []
+        for sink in sinks:
+            if not self._due(sink, tick):
+                continue
+
+            caught_up = sink.idle
+            future = sink.submit(reading)
+            if caught_up:
+                pending.append((sink, future))
+
+        if len(pending) == 0:
+            return
+
+        timeout = self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5)
+        done, late = await asyncio.wait([future for sink, future in pending], timeout=timeout)
+        for sink, future in pending:
+            if future in late:
+                self.log.warning("%s is taking longer than %s seconds. Carrying on without it." % (sink.name, timeout))
+            elif not future.cancelled():
+                # Already logged and counted by the sink
+                future.exception()
+
+    async def _periodic_callback(self, tick):
+
+        if self._accumulator is not None:
+            wr = self._accumulator.result()
+            if wr is None:
+                self.log.warning("No samples were taken in the last update interval. Nothing to report.")
+                return
+        else:
+            wr = await self.take_reading(tick)
+
+        await self.report_reading(wr, tick)
+
+        self._latest_reading = wr
+
+    async def _sample_callback(self, tick):
+        self._accumulator.add(await self.take_reading(tick))
+
+    async def _flush_callback(self, tick=None):
+        await self._loop.run_in_executor(None, super()._flush_callback, tick)
+
+    async def _compact_callback(self, tick=None):
+        await self._loop.run_in_executor(None, super()._compact_callback, tick)
+
+    async def _shutdown(self):
+        self._scheduler.stop()
+
+        sink_timeout = self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5)
+        await asyncio.gather(*[
+            sink.async_stop(sink_timeout)
+            for sink in self._display_sinks + self._repository_sinks
+            ])
+
+        for repo in self.repositories:
+            if isinstance(repo, BufferedRepository):
+                await self._loop.run_in_executor(None, repo.flush)
+            elif isinstance(repo, OutboxRepository):
+                await self._loop.run_in_executor(None, repo.stop, sink_timeout)
+
+        for plugin in self.plugin_manager.getAllPlugins():
+            plugin.plugin_object.shutdown()
+
+    def _start_sink(self, name, target, method):
+        """Internal. Creates a task feeding readings to target.async_method."""
+
+        return AsyncSinkWorker(
+                name,
+                getattr(target, "async_" + method),
+                self.config.getint("GENERAL", "SINK_QUEUE_SIZE", fallback=360),
+                self.config.getfloat("GENERAL", "SINK_TIMEOUT", fallback=5),
+                self.log
+                )
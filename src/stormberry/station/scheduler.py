@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+
+
+class Scheduler():
+    '''
+    Runs jobs on fixed ticks of the monotonic clock, each on its own
+    thread. Tick n of a job falls at its start time plus n intervals,
+    however long the job takes, so the period doesn't drift. A job
+    that runs past one or more of its ticks skips them rather than
+    running again straight away. Jobs are passed the number of the
+    tick they're running for.
+    '''
+
+    def __init__(self, log=None):
+        self.log = log if log is not None else logging
+        self._jobs = []
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def add_job(self, name, interval, callback, delay=0):
+        '''
+        Runs callback every interval seconds, the first time delay
+        seconds after the scheduler starts.
+        '''
+        self._jobs.append((name, interval, callback, delay))
+
+    def start(self):
+        start = time.monotonic()
+        self._stopping.clear()
+
+        for name, interval, callback, delay in self._jobs:
+            thread = threading.Thread(
+                    target=self._run,
+                    args=(name, interval, callback, start + delay),
+                    name="stormberry-" + name,
+                    daemon=True
+                    )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        '''
+        Stops scheduling and waits up to timeout seconds for each
+        running job to finish.
+        '''
+        self._stopping.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+        self._threads = []
+
+    def _run(self, name, interval, callback, first):
+        tick = 0
+        while not self._stopping.wait(max(0, first + tick * interval - time.monotonic())):
+            try:
+                callback(tick)
+            except Exception as e:
+                self.log.error("Scheduled %s failed: %s" % (name, str(e)))
+
+            tick = self._next_tick(name, interval, first, tick, time.monotonic())
+
+    def _next_tick(self, name, interval, first, tick, now):
+        '''
+        The tick to run after this one, skipping any that have
+        already passed.
+        '''
+        upcoming = int((now - first) // interval) + 1
+        if upcoming > tick + 1:
+            self.log.warning("%s overran its %s second interval. Skipping %d tick(s)." % (
+                name, interval, upcoming - tick - 1))
+            return upcoming
+
+        return tick + 1
@@ -0,0 +1,129 @@
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+
+
+class SinkWorker():
+    '''
+    Hands weather readings to one repository or display on a thread
+    of its own, so a slow sink only holds up itself. Readings wait in
+    a queue of up to queue_size; when it's full the oldest is dropped.
+    Keeps counts of how its readings went.
+    '''
+
+    def __init__(self, name, handler, queue_size, timeout, log=None):
+        self.name = name
+        self.handler = handler
+        self.timeout = timeout
+        self.log = log if log is not None else logging
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.slow = 0
+        self.dropped = 0
+        self.queue_size = queue_size
+        self._consecutive_failures = 0
+        self._handling = False
+        self._start()
+
+    def submit(self, reading):
+        '''
+        Queues a reading. The returned Future resolves to whether the
+        sink handled it.
+        '''
+        future = self._new_future()
+        while self._queue.qsize() >= self.queue_size:
+            try:
+                dropped_reading, dropped_future = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            self.dropped += 1
+            dropped_future.cancel()
+            self.log.warning("%s is falling behind. Dropped its reading from %s." % (self.name, dropped_reading.timestr))
+
+        self._queue.put_nowait((reading, future))
+        self.submitted += 1
+        return future
+
+    @property
+    def idle(self):
+        return not self._handling and self._queue.empty()
+
+    def stop(self, timeout=None):
+        '''
+        Lets the sink finish what's queued, waiting up to timeout
+        seconds.
+        '''
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+                'name': self.name,
+                'submitted': self.submitted,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'slow': self.slow,
+                'dropped': self.dropped,
+                'queued': self._queue.qsize()
+                }
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="stormberry-sink-" + self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            reading, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            self._handling = True
+            started = time.monotonic()
+            try:
+                result = self.handler(reading)
+            except Exception as e:
+                self._handling = False
+                self._finished(reading, future, None, e, time.monotonic() - started)
+                continue
+
+            self._handling = False
+            self._finished(reading, future, result, None, time.monotonic() - started)
+
+    def _new_future(self):
+        return Future()
+
+    def _finished(self, reading, future, result, error, elapsed):
+        '''
+        Counts and logs how handling a reading went, and resolves its
+        future.
+        '''
+        if elapsed > self.timeout:
+            self.slow += 1
+            self.log.warning("%s took %.1f seconds with the reading from %s" % (self.name, elapsed, reading.timestr))
+
+        if error is not None:
+            self._failed("%s failed with the reading from %s: %s" % (self.name, reading.timestr, str(error)))
+            future.set_exception(error)
+            return
+
+        if result is False:
+            self._failed("%s couldn't handle the reading from %s" % (self.name, reading.timestr))
+        else:
+            self.succeeded += 1
+            self._consecutive_failures = 0
+
+        future.set_result(result is not False)
+
+    def _failed(self, message):
+        self.failed += 1
+        self._consecutive_failures += 1
+        self.log.error("%s (%d failures in a row)" % (message, self._consecutive_failures))
@@ -1,3 +1,4 @@
+from datetime import datetime
 
 def c_to_f(temp):
     return (temp*1.8)+32
@@ -5,4 +6,141 @@ def c_to_f(temp):
 def weather_list_to_dict_list(weather_list):
     return [x.dict for x in weather_list]
 
+def parse_time(value):
+    '''
+    Turns a repository time argument, a datetime or a date string
+    like "2018-06-01 12:00:00" or "2018-06-01T16:00:00.000Z", into a
+    naive datetime in local time like reading timestamps.
+    '''
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        text = str(value).strip()
+        if text.endswith('Z'):
+            text = text[:-1] + '+00:00'
+
+        try:
+            parsed = datetime.fromisoformat(text)
+        except ValueError:
+            parsed = datetime.strptime(text, "%Y-%m-%d %H:%M:%S")
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+
+    return parsed
+
+def to_epoch(value):
+    return parse_time(value).timestamp()
+
+def mean_of_readings(readings):
+    '''
+    Works out the means for IRepositoryPlugin.get_mean_between from
+    a list of weather readings.
+    '''
+    values = _field_values(readings, ('tempc', 'humidity', 'dewpointc', 'pm_2_5', 'pm_10'))
+    means = dict(
+            (field, sum(values[field]) / len(values[field]) if len(values[field]) > 0 else None)
+            for field in values
+            )
+
+    return {
+            'tempc_avg': means['tempc'],
+            'humidity_avg': means['humidity'],
+            'dewpointc_avg': means['dewpointc'],
+            'pm2_5_avg': means['pm_2_5'],
+            'pm_10_avg': means['pm_10'],
+            }
+
+def extremes_of_readings(readings):
+    '''
+    Works out the minimums and maximums for
+    IRepositoryPlugin.get_extremes_between from a list of weather
+    readings.
+    '''
+    values = _field_values(readings, ('tempc', 'humidity', 'dewpointc', 'pm_2_5', 'pm_10'))
+
+    extremes = {}
+    for field in values:
+        extremes[field + '_min'] = min(values[field]) if len(values[field]) > 0 else None
+        extremes[field + '_max'] = max(values[field]) if len(values[field]) > 0 else None
+
+    return extremes
+
+def _field_values(readings, fields):
+    values = dict((field, []) for field in fields)
+    for reading in readings:
+        reading_values = reading.dict
+        for field in fields:
+            if reading_values[field] is not None:
+                values[field].append(reading_values[field])
+
+    return values
+
+def aggregate_readings(readings, bucket_seconds, fields):
+    '''
+    Summarizes chronologically ordered weather readings into buckets
+    of bucket_seconds, aligned to the epoch. See
+    IRepositoryPlugin.get_aggregates_between for the bucket format.
+    '''
+    buckets = []
+    sums = None
+    bucket = None
+
+    for reading in readings:
+        values = reading.dict
+        epoch = int(reading.timestamp.timestamp())
+        bucket_start = epoch - epoch % bucket_seconds
+
+        if bucket is None or bucket['epoch'] != bucket_start:
+            if bucket is not None:
+                buckets.append(_finish_bucket(bucket, sums, fields))
+
+            bucket = _start_bucket(bucket_start, fields, values)
+            sums = dict.fromkeys(fields, 0)
+
+        bucket['count'] += 1
+        for field in fields:
+            value = values[field]
+            bucket[field + '_last'] = value
+
+            if value is None:
+                continue
+
+            sums[field] += value
+            bucket[field + '_count'] += 1
+            if bucket[field + '_min'] is None or value < bucket[field + '_min']:
+                bucket[field + '_min'] = value
+            if bucket[field + '_max'] is None or value > bucket[field + '_max']:
+                bucket[field + '_max'] = value
+
+    if bucket is not None:
+        buckets.append(_finish_bucket(bucket, sums, fields))
+
+    return buckets
+
+def _start_bucket(bucket_start, fields, first_values):
+    bucket_time = datetime.fromtimestamp(bucket_start)
+    bucket = {
+            'epoch': bucket_start,
+            'datetime': bucket_time,
+            'timestr': bucket_time.strftime("%Y-%m-%d %H:%M:%S"),
+            'count': 0
+            }
+
+    for field in fields:
+        bucket[field + '_avg'] = None
+        bucket[field + '_min'] = None
+        bucket[field + '_max'] = None
+        bucket[field + '_count'] = 0
+        bucket[field + '_first'] = first_values[field]
+        bucket[field + '_last'] = None
+
+    return bucket
+
+def _finish_bucket(bucket, sums, fields):
+    for field in fields:
+        if bucket[field + '_count'] > 0:
+            bucket[field + '_avg'] = sums[field] / bucket[field + '_count']
+
+    return bucket
 
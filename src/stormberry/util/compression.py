@@ -0,0 +1,189 @@
+'''
+Gorilla style time series compression, after "Gorilla: A Fast,
+Scalable, In-Memory Time Series Database" (Pelkonen et al., 2015).
+
+Timestamps (whole seconds) are stored as the difference between
+consecutive deltas, which is zero for readings taken at a steady
+interval. Values are stored as the XOR of their bits with the previous
+value's, which is zero or has few meaningful bits for values that
+change slowly.
+'''
+import struct
+
+_double = struct.Struct('>d')
+_uint64 = struct.Struct('>Q')
+
+# (prefix, prefix bits, value bits) for delta-of-delta ranges
+_TIMESTAMP_BUCKETS = (
+        (0b10, 2, 7),
+        (0b110, 3, 9),
+        (0b1110, 4, 12),
+        )
+_TIMESTAMP_FALLBACK = (0b1111, 4, 32)
+
+
+class BitWriter():
+
+    def __init__(self):
+        self._bytes = bytearray()
+        self._pending = 0
+        self._pending_bits = 0
+
+    def write(self, value, bits):
+        self._pending = (self._pending << bits) | value
+        self._pending_bits += bits
+
+        while self._pending_bits >= 8:
+            self._pending_bits -= 8
+            self._bytes.append((self._pending >> self._pending_bits) & 0xff)
+
+        self._pending &= (1 << self._pending_bits) - 1
+
+    def getvalue(self):
+        if self._pending_bits == 0:
+            return bytes(self._bytes)
+
+        return bytes(self._bytes) + bytes([(self._pending << (8 - self._pending_bits)) & 0xff])
+
+
+class BitReader():
+
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+        self._pending = 0
+        self._pending_bits = 0
+
+    def read(self, bits):
+        while self._pending_bits < bits:
+            self._pending = (self._pending << 8) | self._data[self._position]
+            self._position += 1
+            self._pending_bits += 8
+
+        self._pending_bits -= bits
+        value = self._pending >> self._pending_bits
+        self._pending &= (1 << self._pending_bits) - 1
+        return value
+
+
+def encode_timestamps(writer, timestamps):
+    '''
+    Writes whole second timestamps. The first is written in full, each
+    one after as the change in delta from the one before it.
+    '''
+    previous = None
+    previous_delta = 0
+
+    for timestamp in timestamps:
+        if previous is None:
+            writer.write(timestamp & 0xffffffffffffffff, 64)
+            previous = timestamp
+            continue
+
+        delta = timestamp - previous
+        delta_of_delta = delta - previous_delta
+        previous = timestamp
+        previous_delta = delta
+
+        if delta_of_delta == 0:
+            writer.write(0, 1)
+            continue
+
+        for prefix, prefix_bits, value_bits in _TIMESTAMP_BUCKETS + (_TIMESTAMP_FALLBACK,):
+            bias = (1 << (value_bits - 1)) - 1
+            if -bias <= delta_of_delta <= bias + 1 or value_bits == 32:
+                writer.write(prefix, prefix_bits)
+                writer.write((delta_of_delta + bias) & ((1 << value_bits) - 1), value_bits)
+                break
+
+def decode_timestamps(reader, count):
+    timestamps = []
+    previous = None
+    previous_delta = 0
+
+    for i in range(count):
+        if previous is None:
+            previous = reader.read(64)
+            if previous >= 1 << 63:
+                previous -= 1 << 64
+            timestamps.append(previous)
+            continue
+
+        if reader.read(1) == 0:
+            delta_of_delta = 0
+        else:
+            for prefix, prefix_bits, value_bits in _TIMESTAMP_BUCKETS + (_TIMESTAMP_FALLBACK,):
+                # Every prefix is ones ended by a zero, except the last
+                if value_bits == 32 or reader.read(1) == 0:
+                    bias = (1 << (value_bits - 1)) - 1
+                    delta_of_delta = reader.read(value_bits) - bias
+                    break
+
+        previous_delta += delta_of_delta
+        previous += previous_delta
+        timestamps.append(previous)
+
+    return timestamps
+
+def encode_floats(writer, values):
+    '''
+    Writes doubles. The first is written in full, each one after as
+    the meaningful bits of its XOR with the one before it, reusing the
+    previous leading/trailing zero counts when they still fit.
+    '''
+    previous = None
+    leading = -1
+    trailing = 0
+
+    for value in values:
+        bits = _uint64.unpack(_double.pack(value))[0]
+        if previous is None:
+            writer.write(bits, 64)
+            previous = bits
+            continue
+
+        xor = bits ^ previous
+        previous = bits
+
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+
+        writer.write(1, 1)
+        value_leading = min(64 - xor.bit_length(), 31)
+        value_trailing = (xor & -xor).bit_length() - 1
+
+        if leading >= 0 and value_leading >= leading and value_trailing >= trailing:
+            writer.write(0, 1)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+            continue
+
+        leading = value_leading
+        trailing = value_trailing
+        meaningful = 64 - leading - trailing
+        writer.write(1, 1)
+        writer.write(leading, 5)
+        # 64 meaningful bits don't fit in 6 bits, and 0 never happens
+        writer.write(meaningful & 0x3f, 6)
+        writer.write(xor >> trailing, meaningful)
+
+def decode_floats(reader, count):
+    values = []
+    previous = None
+    leading = 0
+    trailing = 0
+
+    for i in range(count):
+        if previous is None:
+            previous = reader.read(64)
+        elif reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+
+            previous ^= reader.read(64 - leading - trailing) << trailing
+
+        values.append(_double.unpack(_uint64.pack(previous))[0])
+
+    return values
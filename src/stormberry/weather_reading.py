@@ -5,6 +5,19 @@ class WeatherReading():
 
     READINGS_PRINT_TEMPLATE = 'Temp: %sC (%sF), Humidity: %s%%, Pressure: %s inHg, Wind MPH: %s'
 
+    # The measured values of a reading, in the order used by raw and
+    # from_raw. Everything else about a reading is derived from these.
+    RAW_FIELDS = (
+            'tempc',
+            'humidity',
+            'pressure_millibars',
+            'wind_mph',
+            'pm_2_5',
+            'pm_10',
+            'precipitation_cm',
+            'noise_dB'
+            )
+
     def __init__(
             self,
             tempc=None,
@@ -157,6 +170,40 @@ class WeatherReading():
     def fields(self):
         return self.dict.keys()
 
+    @property
+    def raw(self):
+        '''
+        The unrounded measured values, in RAW_FIELDS order
+        '''
+        return (
+                self.__tempc,
+                self.__humidity,
+                self.__pressure,
+                self.__wind_mph,
+                self.__pm_2_5,
+                self.__pm_10,
+                self.__precipitation_cm,
+                self.__noise_dB
+                )
+
+    @classmethod
+    def from_raw(cls, date, raw):
+        '''
+        Builds a reading from a date and values in RAW_FIELDS order
+        '''
+        tempc, humidity, pressure, wind_mph, pm_2_5, pm_10, precipitation_cm, noise_dB = raw
+        return cls(
+                tempc=tempc,
+                humidity=humidity,
+                pressureMillibars=pressure,
+                date=date,
+                wind_mph=wind_mph,
+                pm_2_5=pm_2_5,
+                pm_10=pm_10,
+                precipitation_cm=precipitation_cm,
+                noise_dB=noise_dB
+                )
+
     def merge(self, weather_reading):
         self.__date = self.__date if self.__date is not None else weather_reading.timestamp
         self.__tempc = self.__tempc if self.__tempc is not None else weather_reading.tempc
@@ -165,7 +212,7 @@ class WeatherReading():
         self.__wind_mph = self.__wind_mph if self.__wind_mph is not None else weather_reading.wind_mph
         self.__pm_2_5 = self.__pm_2_5 if self.__pm_2_5 is not None else weather_reading.pm_2_5
         self.__precipitation_cm = self.__precipitation_cm if self.__precipitation_cm is not None else weather_reading.__precipitation_cm
-        self.__noise_dB = self.__noise_dB if self.__noise_dB is not None else weather_reading.noise_dB,
+        self.__noise_dB = self.__noise_dB if self.__noise_dB is not None else weather_reading.noise_dB
         self.__pm_10 = self.__pm_10 if self.__pm_10 is not None else weather_reading.pm_10
 
     def __str__(self):